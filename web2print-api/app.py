@@ -1,30 +1,86 @@
-from flask import Flask, request, render_template, jsonify, redirect, url_for, session, flash
+from flask import Flask, request, render_template, jsonify, redirect, url_for, session, flash, g
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-import PyPDF2
-import pymupdf as fitz  # PyMuPDF para análise de PDFs
+from sqlalchemy import select, insert, update, delete, bindparam, func, text, inspect
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import selectinload, load_only
+from sqlalchemy.exc import IntegrityError
+import sqlite3
 import os
 from dotenv import load_dotenv
 
 # Carregar variáveis do .env
 load_dotenv()
+import re
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+import socket
+import ipaddress
+from http.cookiejar import DefaultCookiePolicy
 import uuid
 import hashlib
+import hmac
+import io
 import tempfile
 import contextlib
+import collections
+import gc
+import multiprocessing
+import atexit
+import fcntl
 import logging
+import logging.handlers
+import queue
 import time
-import json
+import orjson
+import operator
 import threading
+import bisect
 from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
-from functools import wraps
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from functools import wraps, lru_cache
+from types import MappingProxyType
 from flask_wtf.csrf import CSRFProtect
+from jinja2 import FileSystemBytecodeCache
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Serialização JSON do Flask (jsonify, request.get_json, sessão) via orjson.
+    
+    Datas continuam passando pelo default() do Flask (formato HTTP date),
+    para que as respostas mantenham o mesmo formato de antes.
+    """
+    _options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._options).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self._options),
+            mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Colunas db.JSON (de)serializadas via orjson em vez do json da stdlib
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'json_serializer': lambda obj: orjson.dumps(obj).decode(),
+    'json_deserializer': orjson.loads,
+}
 
 # Adicionar rota para servir uploads
 @app.route('/uploads/<path:filename>')
@@ -42,9 +98,30 @@ def uploaded_file(filename):
 MAX_PDF_SIZE_SYNC = int(os.getenv('MAX_SYNC_PDF_SIZE', '10485760'))  # 10MB default
 MAX_PDF_SIZE_TOTAL = int(os.getenv('MAX_PDF_SIZE_TOTAL', '52428800'))  # 50MB total
 HEALTH_CHECK_TIMEOUT = int(os.getenv('HEALTH_CHECK_TIMEOUT', '3'))  # 3 segundos
+HEALTH_DB_CHECK_TTL = float(os.getenv('HEALTH_DB_CHECK_TTL', '5'))  # validade do último SELECT 1 do /health
 PDF_DOWNLOAD_TIMEOUT = int(os.getenv('PDF_DOWNLOAD_TIMEOUT', '30'))  # 30 segundos
+PDF_DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # leitura/gravação do download em blocos de 1MB
+JOB_PROGRESS_INTERVAL = 1.0  # mínimo de segundos entre commits de progresso de um job
 CLEANUP_LOG_LEVEL = os.getenv('CLEANUP_LOG_LEVEL', 'INFO').upper()
 ENABLE_SIZE_PRECHECK = os.getenv('ENABLE_SIZE_PRECHECK', 'true').lower() == 'true'
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', str(MAX_PDF_SIZE_TOTAL)))  # limite do /upload (50MB default)
+UPLOAD_ASYNC_MIN_SIZE = int(os.getenv('UPLOAD_ASYNC_MIN_SIZE', '1048576'))  # uploads acima de 1MB vão para o worker
+PDF_COLOR_DETECTION = os.getenv('PDF_COLOR_DETECTION', 'objects').lower()  # 'objects' (texto/imagens) ou 'raster'
+PDF_RASTER_SCALE = float(os.getenv('PDF_RASTER_SCALE', '0.15'))  # escala da miniatura no modo 'raster'
+PDF_SAMPLE_PAGES = int(os.getenv('PDF_SAMPLE_PAGES', '0'))  # >1: analisar só N páginas espaçadas e extrapolar (0 = todas)
+
+# Limites já formatados para logs e mensagens de rejeição (calculados uma vez)
+MAX_PDF_SIZE_SYNC_MB = f"{MAX_PDF_SIZE_SYNC / 1048576:.1f}MB"
+MAX_PDF_SIZE_TOTAL_MB = f"{MAX_PDF_SIZE_TOTAL / 1048576:.1f}MB"
+UPLOAD_TOO_LARGE_ERROR = f'Arquivo muito grande. Tamanho máximo: {MAX_UPLOAD_SIZE / 1048576:.0f}MB'
+
+# Teto de qualquer corpo de request (o maior é o multipart do /upload). Vale
+# também para corpos chunked, sem Content-Length: o Werkzeug interrompe a
+# leitura do form com 413 em vez de gravar o upload inteiro em disco, inclusive
+# quando quem lê o form é a checagem de CSRF, antes da view
+UPLOAD_MULTIPART_OVERHEAD = 64 * 1024  # boundary, cabeçalhos das partes e demais campos
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + UPLOAD_MULTIPART_OVERHEAD
+PDF_RASTER_TOLERANCE = int(os.getenv('PDF_RASTER_TOLERANCE', '0'))  # diferença máx. entre R, G e B de um pixel cinza
 
 # Configurar logging estruturado
 logging.basicConfig(
@@ -53,12 +130,67 @@ logging.basicConfig(
 )
 logger = logging.getLogger('web2print')
 
+# Os logs do app só entram numa fila no thread do request; um thread de
+# fundo (QueueListener) formata e escreve nos handlers do root. Assim a
+# formatação e o write() no stderr saem do caminho do request
+_log_queue_handler = None
+_log_listener = None
+
+def _start_log_queue():
+    """Liga (ou religa, após um fork) a fila de logs do logger do app"""
+    global _log_queue_handler, _log_listener
+    log_queue = queue.SimpleQueue()
+    if _log_queue_handler is not None:
+        logger.removeHandler(_log_queue_handler)
+    _log_queue_handler = logging.handlers.QueueHandler(log_queue)
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, *logging.getLogger().handlers, respect_handler_level=True
+    )
+    logger.addHandler(_log_queue_handler)
+    logger.propagate = False
+    _log_listener.start()
+
+def _log_without_queue():
+    """
+    Num processo filho (pool de análise), escreve direto nos handlers do root.
+    
+    O filho não herda o thread do listener, e os workers do pool logam pouco
+    e saem sem passar pelo atexit: uma fila própria só perderia os últimos
+    registros. O listener do processo pai continua intacto
+    """
+    global _log_queue_handler, _log_listener
+    if _log_queue_handler is not None:
+        logger.removeHandler(_log_queue_handler)
+    _log_queue_handler = None
+    _log_listener = None
+    logger.propagate = True
+
+_start_log_queue()
+# Na saída do processo, escreve o que restou na fila
+atexit.register(lambda: _log_listener and _log_listener.stop())
+
 # ============================================
 # CONTEXT MANAGER PARA ARQUIVOS TEMPORÁRIOS
 # ============================================
 
+def _open_anonymous_temp_file():
+    """
+    Abre um arquivo temporário sem nome (O_TMPFILE, Linux) e retorna o fd.
+    
+    O inode nunca aparece no diretório e o kernel o libera ao fechar o fd,
+    mesmo se o processo morrer. Retorna None quando o sistema ou o
+    filesystem do diretório temporário não suportam O_TMPFILE.
+    """
+    flag = getattr(os, 'O_TMPFILE', None)
+    if flag is None or not os.path.isdir('/proc/self/fd'):
+        return None
+    try:
+        return os.open(tempfile.gettempdir(), flag | os.O_RDWR | os.O_CLOEXEC, 0o600)
+    except OSError:
+        return None
+
 @contextlib.contextmanager
-def secure_temp_pdf_file(suffix='.pdf', prefix='web2print_'):
+def secure_temp_pdf_file(suffix='.pdf', prefix='web2print_', anonymous=False):
     """
     Context manager robusto para arquivos PDF temporários com cleanup garantido.
     
@@ -66,48 +198,67 @@ def secure_temp_pdf_file(suffix='.pdf', prefix='web2print_'):
     - Cleanup automático garantido via context manager
     - Logging detalhado de operações
     - Tratamento de erro robusto
-    - Geração de nomes únicos com timestamp
+    - Nomes únicos gerados pelo tempfile
+    
+    Por padrão é um NamedTemporaryFile, que pode ser reaberto por outros
+    processos (o pool de análise). Com anonymous=True, no Linux, o arquivo é
+    anônimo (O_TMPFILE) e o caminho entregue é /proc/self/fd/N: sem link no
+    diretório e liberado pelo kernel ao fechar o fd. Só serve para leituras
+    neste processo: o caminho não vale em outro processo, e o número do fd é
+    reaproveitado depois do fechamento.
     """
+    fd = _open_anonymous_temp_file() if anonymous else None
+    if fd is not None:
+        temp_path = f'/proc/self/fd/{fd}'
+        logger.info("Arquivo temporário anônimo criado: %s", temp_path)
+        try:
+            yield temp_path
+        except Exception as e:
+            logger.error("Erro durante uso do arquivo temporário %s: %s", temp_path, e)
+            raise
+        finally:
+            os.close(fd)
+            logger.info("Arquivo temporário anônimo liberado: %s", temp_path)
+        return
+    
     temp_path = None
-    start_time = time.time()
+    start_time = time.monotonic()
     
     try:
-        # Criar arquivo temporário com nome único
-        timestamp = int(time.time() * 1000)  # milliseconds
+        # Criar arquivo temporário com nome único (o sufixo aleatório do
+        # tempfile já garante a unicidade)
         with tempfile.NamedTemporaryFile(
             suffix=suffix, 
-            prefix=f"{prefix}{timestamp}_", 
+            prefix=prefix, 
             delete=False
         ) as temp_file:
             temp_path = temp_file.name
             
-        logger.info(f"Arquivo temporário criado: {temp_path}")
+        logger.info("Arquivo temporário criado: %s", temp_path)
         yield temp_path
         
     except Exception as e:
-        logger.error(f"Erro durante uso do arquivo temporário {temp_path}: {e}")
+        logger.error("Erro durante uso do arquivo temporário %s: %s", temp_path, e)
         raise
         
     finally:
         # CRÍTICO: Cleanup garantido independente de sucesso/erro
-        cleanup_duration = time.time() - start_time
+        cleanup_duration = time.monotonic() - start_time
         
-        if temp_path and os.path.exists(temp_path):
+        if temp_path:
+            # Um único unlink: a ausência do arquivo vem como FileNotFoundError,
+            # sem exists/getsize antes
             try:
-                file_size = os.path.getsize(temp_path)
-                os.remove(temp_path)
-                logger.info(
-                    f"Arquivo temporário removido com sucesso: {temp_path} "
-                    f"(tamanho: {file_size:,} bytes, duração: {cleanup_duration:.2f}s)"
-                )
+                os.unlink(temp_path)
+                logger.info("Arquivo temporário removido com sucesso: %s (duração: %.2fs)",
+                            temp_path, cleanup_duration)
+            except FileNotFoundError:
+                logger.warning("Arquivo temporário não encontrado para cleanup: %s", temp_path)
             except OSError as cleanup_error:
-                logger.error(
-                    f"FALHA CRÍTICA: Não foi possível remover arquivo temporário {temp_path}: {cleanup_error}"
-                )
+                logger.error("FALHA CRÍTICA: Não foi possível remover arquivo temporário %s: %s",
+                             temp_path, cleanup_error)
                 # Em produção: alertar admin ou adicionar a lista de cleanup
                 # TODO: Implementar sistema de cleanup de emergência
-        elif temp_path:
-            logger.warning(f"Arquivo temporário não encontrado para cleanup: {temp_path}")
         else:
             logger.debug("Nenhum arquivo temporário para cleanup")
 
@@ -115,12 +266,154 @@ def secure_temp_pdf_file(suffix='.pdf', prefix='web2print_'):
 # FUNÇÕES DE VERIFICAÇÃO DE TAMANHO
 # ============================================
 
-def check_pdf_size_before_download(url, max_size=None):
+# Sessão com pool de conexões para os downloads de PDF por URL (request
+# síncrono e worker). Cookies recebidos de URLs arbitrárias são descartados
+# para não vazarem entre requisições de clientes diferentes
+#
+# SEGURANÇA (SSRF): o IP é validado no momento da conexão, não só antes do
+# request: um DNS que responda um IP público na checagem e um interno no
+# connect (DNS rebinding) não alcança a rede interna, e o worker assíncrono
+# (que baixa minutos depois) também passa pela validação
+
+class BlockedAddressError(OSError):
+    """Destino de download resolvido para um IP interno/privado"""
+
+def is_blocked_ip(ip):
+    """IPs privados/locais/reservados (IPv4 e IPv6) não podem ser baixados"""
+    ip_obj = ipaddress.ip_address(ip)
+    return (ip_obj.is_private or ip_obj.is_loopback or
+            ip_obj.is_link_local or ip_obj.is_reserved or
+            ip_obj.is_multicast)
+
+# IPs já resolvidos e validados pelo endpoint para o request em andamento
+# (por thread): a conexão os usa sem repetir a consulta DNS
+_pinned_download_host = threading.local()
+
+@contextlib.contextmanager
+def pinned_download_addresses(hostname, addresses):
+    """Durante o bloco, conexões de download para hostname usam estes IPs"""
+    _pinned_download_host.value = (hostname, tuple(addresses))
+    try:
+        yield
+    finally:
+        _pinned_download_host.value = None
+
+# Resoluções já validadas ficam em cache por DNS_CACHE_TTL segundos: os
+# plugins WordPress costumam baixar sempre dos mesmos poucos hosts. Só
+# respostas aprovadas entram no cache (um host bloqueado é resolvido de novo)
+DNS_CACHE_TTL = float(os.getenv('DNS_CACHE_TTL', '60'))
+DNS_CACHE_SIZE = 256
+_dns_cache = collections.OrderedDict()
+_dns_cache_lock = threading.Lock()
+
+def resolve_download_host(hostname):
+    """
+    Resolve hostname e valida todos os IPs (A e AAAA), parando no primeiro
+    bloqueado.
+    
+    Returns:
+        tuple: IPs públicos, sem repetição, na ordem do getaddrinfo
+    
+    Raises:
+        socket.gaierror: hostname não resolvido
+        BlockedAddressError: algum IP é interno/privado
+    """
+    now = time.monotonic()
+    with _dns_cache_lock:
+        cached = _dns_cache.get(hostname)
+        if cached is not None and cached[0] > now:
+            _dns_cache.move_to_end(hostname)
+            return cached[1]
+    
+    # SOCK_STREAM: um registro por IP, sem as cópias UDP/RAW do AF_UNSPEC
+    addresses = []
+    for *_, sockaddr in socket.getaddrinfo(hostname, None, type=socket.SOCK_STREAM):
+        ip = sockaddr[0]
+        if ip in addresses:
+            continue
+        if is_blocked_ip(ip):
+            raise BlockedAddressError(f'IP {ip} é interno/privado - bloqueado por segurança')
+        addresses.append(ip)
+    addresses = tuple(addresses)
+    
+    with _dns_cache_lock:
+        _dns_cache[hostname] = (now + DNS_CACHE_TTL, addresses)
+        _dns_cache.move_to_end(hostname)
+        while len(_dns_cache) > DNS_CACHE_SIZE:
+            _dns_cache.popitem(last=False)
+    return addresses
+
+def _download_addresses(hostname):
+    """IPs públicos para conectar em hostname (os fixados ou uma resolução validada)"""
+    pinned = getattr(_pinned_download_host, 'value', None)
+    if pinned and pinned[0] == hostname:
+        return pinned[1]
+    return resolve_download_host(hostname)
+
+class _ValidatedAddressConnectionMixin:
+    """Conecta só nos IPs de _download_addresses; Host, SNI e certificado seguem o hostname"""
+    def _new_conn(self):
+        hostname = self._dns_host
+        addresses = _download_addresses(hostname)
+        try:
+            for index, ip in enumerate(addresses):
+                self._dns_host = ip
+                try:
+                    return super()._new_conn()
+                except urllib3.exceptions.HTTPError:
+                    if index == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = hostname
+
+class _ValidatedHTTPConnection(_ValidatedAddressConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class _ValidatedHTTPSConnection(_ValidatedAddressConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class _ValidatedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _ValidatedHTTPConnection
+
+class _ValidatedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _ValidatedHTTPSConnection
+
+class PdfDownloadAdapter(HTTPAdapter):
+    """HTTPAdapter cujas conexões passam pela validação de IP acima"""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _ValidatedHTTPConnectionPool,
+            'https': _ValidatedHTTPSConnectionPool,
+        }
+
+PDF_DOWNLOAD_SESSION = requests.Session()
+PDF_DOWNLOAD_SESSION.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+PDF_DOWNLOAD_SESSION.mount('https://', PdfDownloadAdapter(pool_connections=16, pool_maxsize=32))
+PDF_DOWNLOAD_SESSION.mount('http://', PdfDownloadAdapter(pool_connections=16, pool_maxsize=32))
+
+def _response_total_size(response):
+    """Tamanho total do corpo pelos cabeçalhos (Content-Range de um 206 ou Content-Length), ou None"""
+    content_range = response.headers.get('content-range')
+    if content_range:
+        _, _, total = content_range.rpartition('/')
+        if total.isdigit():
+            return int(total)
+    content_length = response.headers.get('content-length')
+    if content_length and content_length.isdigit():
+        return int(content_length)
+    return None
+
+def check_pdf_size_before_download(response, max_size=None):
     """
-    Verifica o tamanho do PDF antes do download para otimizar performance.
+    Verifica o tamanho do PDF antes de ler o corpo do download.
+    
+    Usa os cabeçalhos do próprio GET (stream=True) que fará o download: não
+    há requisição HEAD separada (um round-trip e um handshake TLS a menos, e
+    funciona com origens que recusam HEAD ou só informam o tamanho no GET).
     
     Args:
-        url: URL do PDF para verificar
+        response: resposta do GET aberta com stream=True, corpo ainda não lido
         max_size: Tamanho máximo permitido em bytes
         
     Returns:
@@ -131,33 +424,22 @@ def check_pdf_size_before_download(url, max_size=None):
         
     max_size = max_size or MAX_PDF_SIZE_TOTAL
     
-    try:
-        logger.info(f"Verificando tamanho do PDF: {url}")
-        head_response = requests.head(url, timeout=5, allow_redirects=True)
-        head_response.raise_for_status()
-        
-        content_length = head_response.headers.get('content-length')
-        if not content_length:
-            logger.warning(f"Content-Length não disponível para {url}")
-            return {'allowed': True, 'size': 0, 'message': 'Tamanho não determinável'}
-            
-        file_size = int(content_length)
-        
-        if file_size > max_size:
-            logger.warning(f"Arquivo muito grande: {file_size:,} bytes (máx: {max_size:,})")
-            return {
-                'allowed': False, 
-                'size': file_size,
-                'message': f'Arquivo muito grande: {file_size/1024/1024:.1f}MB (máx: {max_size/1024/1024:.1f}MB)'
-            }
-            
-        logger.info(f"Tamanho do arquivo OK: {file_size:,} bytes")
-        return {'allowed': True, 'size': file_size, 'message': 'Tamanho aprovado'}
+    file_size = _response_total_size(response)
+    if file_size is None:
+        logger.warning("Content-Length não disponível para %s", response.url)
+        return {'allowed': True, 'size': 0, 'message': 'Tamanho não determinável'}
+    
+    if file_size > max_size:
+        logger.warning("Arquivo muito grande: %d bytes (máx: %d)", file_size, max_size)
+        max_label = MAX_PDF_SIZE_TOTAL_MB if max_size == MAX_PDF_SIZE_TOTAL else f"{max_size/1048576:.1f}MB"
+        return {
+            'allowed': False, 
+            'size': file_size,
+            'message': f'Arquivo muito grande: {file_size/1048576:.1f}MB (máx: {max_label})'
+        }
         
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Erro ao verificar tamanho do PDF {url}: {e}")
-        # Em caso de erro, permitir download (pode ser problema temporário)
-        return {'allowed': True, 'size': 0, 'message': f'Erro na verificação: {e}'}
+    logger.info("Tamanho do arquivo OK: %d bytes", file_size)
+    return {'allowed': True, 'size': file_size, 'message': 'Tamanho aprovado'}
 
 def get_processing_strategy(file_size):
     """
@@ -186,25 +468,42 @@ def get_processing_strategy(file_size):
 # FUNÇÕES DE MONITORING MELHORADAS
 # ============================================
 
+# Timestamp ISO das respostas/logs, formatado no máximo uma vez por segundo.
+# Corrida entre threads é benigna: no pior caso duas formatam o mesmo segundo
+_ts_cache = [0, '']
+
+def now_iso():
+    """datetime.now().isoformat() com granularidade de 1 segundo (cacheado)"""
+    second = int(time.time())
+    if second != _ts_cache[0]:
+        _ts_cache[:] = [second, datetime.fromtimestamp(second).isoformat()]
+    return _ts_cache[1]
+
 def log_api_performance(operation, duration, file_size=None, success=True):
     """
     Log estruturado de performance para monitoramento.
+    
+    Com o nível de log acima do registro (ex.: CLEANUP_LOG_LEVEL=WARNING em
+    produção), nada é montado: nem o dict, nem o timestamp, nem o JSON.
     """
+    level = logging.INFO if success else logging.WARNING
+    if not logger.isEnabledFor(level):
+        return
+    
     log_data = {
         'operation': operation,
         'duration_seconds': round(duration, 3),
         'success': success,
-        'timestamp': datetime.now().isoformat()
+        'timestamp': now_iso()
     }
     
     if file_size:
         log_data['file_size_bytes'] = file_size
-        log_data['processing_rate_mb_per_sec'] = round((file_size / 1024 / 1024) / duration, 2)
+        if duration > 0:
+            log_data['processing_rate_mb_per_sec'] = round((file_size / 1024 / 1024) / duration, 2)
     
-    if success:
-        logger.info(f"Performance: {log_data}")
-    else:
-        logger.warning(f"Performance (failed): {log_data}")
+    logger.log(level, "Performance%s: %s", '' if success else ' (failed)',
+               orjson.dumps(log_data).decode())
 
 # SEGURANÇA: Configuração de chave secreta e sessões
 secret_key = os.getenv('SECRET_KEY', 'web2print-secret-key-2024-replit-env')
@@ -222,14 +521,51 @@ app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Strict'  # Mais restritivo para admin
 app.config['PERMANENT_SESSION_LIFETIME'] = 1800  # 30 minutos
 
+# Templates em produção: bytecode compilado guardado em disco (reaproveitado
+# por todos os workers e entre reinícios) e sem checar o mtime dos arquivos
+# a cada render
+if is_production:
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    # Sem argumentos: diretório por usuário (_jinja2-cache-<uid>) que o
+    # próprio Jinja cria e valida (dono e permissão 0700) antes de usar
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
 db = SQLAlchemy(app)
 csrf = CSRFProtect(app)  # Proteção CSRF
+
+
+@event.listens_for(Engine, "connect")
+def _tune_db_connection(dbapi_connection, connection_record):
+    """
+    Ajustes por conexão nova do pool.
+    
+    SQLite: WAL + cache maior + mmap, leituras do admin não bloqueiam nos
+    commits dos uploads. PostgreSQL: timeouts de sessão para que uma query
+    travada não segure um worker indefinidamente.
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-65536")  # 64 MB
+        cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+    elif type(dbapi_connection).__module__.startswith('psycopg'):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET statement_timeout = '30s'")
+        cursor.execute("SET lock_timeout = '5s'")
+        cursor.close()
+        # O driver abre transação implícita: sem commit o SET seria desfeito
+        dbapi_connection.commit()
+
+
 app.app_context().push()
 
 # Log de inicialização com configurações
 logger.info(f"Web2Print iniciado com configurações:")
-logger.info(f"  - MAX_PDF_SIZE_SYNC: {MAX_PDF_SIZE_SYNC/1024/1024:.1f}MB")
-logger.info(f"  - MAX_PDF_SIZE_TOTAL: {MAX_PDF_SIZE_TOTAL/1024/1024:.1f}MB")
+logger.info(f"  - MAX_PDF_SIZE_SYNC: {MAX_PDF_SIZE_SYNC_MB}")
+logger.info(f"  - MAX_PDF_SIZE_TOTAL: {MAX_PDF_SIZE_TOTAL_MB}")
 logger.info(f"  - HEALTH_CHECK_TIMEOUT: {HEALTH_CHECK_TIMEOUT}s")
 logger.info(f"  - ENABLE_SIZE_PRECHECK: {ENABLE_SIZE_PRECHECK}")
 logger.info(f"  - Ambiente: {'Produção' if is_production else 'Desenvolvimento'}")
@@ -257,7 +593,18 @@ class User(db.Model):
     finishing = db.Column(db.String(100), nullable=True)      # 'laminacao', 'verniz', 'dobra', etc
     copy_quantity = db.Column(db.Integer, nullable=True)      # quantidade de cópias
     total_cost = db.Column(db.Float, nullable=True)           # custo total final
+    cost_details_json = db.Column(db.Text, nullable=True)     # detalhamento do custo (JSON) exibido no carrinho
     order_configured = db.Column(db.Boolean, default=False)   # se o pedido foi configurado
+    
+    # A busca por CPF (feita em quase todo request) usa o índice da própria
+    # restrição UNIQUE da coluna
+    __table_args__ = (
+        # Filtro de pedidos do dashboard (order_configured + total_cost); com
+        # paper_type no fim, receita e histograma de papel são lidos só do índice
+        db.Index('ix_user_configured_cost_paper', 'order_configured', 'total_cost', 'paper_type'),
+        # Contagem de uploads do dashboard (uploaded_file IS NOT NULL)
+        db.Index('ix_user_uploaded', 'uploaded_file'),
+    )
 
 class PaperType(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -290,6 +637,9 @@ class BindingType(db.Model):
     price = db.Column(db.Float, nullable=False)  # preço da encadernação
     active = db.Column(db.Boolean, default=True, nullable=False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    
+    # Busca por nome entre os ativos resolvida só pelo índice
+    __table_args__ = (db.Index('ix_binding_active_name', 'active', 'name'),)
 
 class FinishingType(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -299,6 +649,9 @@ class FinishingType(db.Model):
     price = db.Column(db.Float, nullable=False)  # preço do acabamento
     active = db.Column(db.Boolean, default=True, nullable=False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    
+    # Busca por nome entre os ativos resolvida só pelo índice
+    __table_args__ = (db.Index('ix_finishing_active_name', 'active', 'name'),)
 
 # Modelo para controle administrativo simples
 class Admin(db.Model):
@@ -309,33 +662,148 @@ class Admin(db.Model):
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
 
 # MODELO PARA SISTEMA ASSÍNCRONO - PRIORIDADE 1
+JSON_DOCUMENT = db.JSON().with_variant(JSONB(), 'postgresql')
+
 class Job(db.Model):
     id = db.Column(db.String(36), primary_key=True)  # UUID como string
-    job_type = db.Column(db.String(50), nullable=False)  # 'pdf_analysis_url'
+    job_type = db.Column(db.String(50), nullable=False)  # 'pdf_analysis_url', 'pdf_analysis_upload'
     status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, completed, failed
     progress = db.Column(db.Integer, nullable=False, default=0)  # 0-100
-    input_data = db.Column(db.Text, nullable=False)  # JSON com dados de entrada
-    result_data = db.Column(db.Text, nullable=True)  # JSON com resultado
+    # JSON com dados de entrada / resultado: JSONB no PostgreSQL (binário, sem
+    # re-parse no servidor); no SQLite continua sendo texto
+    input_data = db.Column(JSON_DOCUMENT, nullable=False)
+    result_data = db.Column(JSON_DOCUMENT, nullable=True)
     error_message = db.Column(db.String(500), nullable=True)  # mensagem de erro
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     expires_at = db.Column(db.DateTime, nullable=False)  # quando o job expira
     started_at = db.Column(db.DateTime, nullable=True)  # quando começou processamento
     completed_at = db.Column(db.DateTime, nullable=True)  # quando terminou
     
-    # Índices para consultas eficientes
+    # Índices para consultas eficientes. A fila do worker só procura jobs
+    # pendentes: o índice parcial cobre apenas essas linhas e não cresce com o
+    # histórico de jobs concluídos/falhos
     __table_args__ = (
-        db.Index('idx_job_status_created', 'status', 'created_at'),
+        db.Index('idx_job_pending_created', 'created_at',
+                 sqlite_where=text("status = 'pending'"),
+                 postgresql_where=text("status = 'pending'")),
         db.Index('idx_job_expires', 'expires_at'),
     )
 
-db.create_all()
+    # A (de)serialização fica no tipo da coluna (via orjson, ver
+    # SQLALCHEMY_ENGINE_OPTIONS)
+    def set_input(self, data):
+        self.input_data = data
+
+    def get_input(self):
+        return self.input_data
+
+    def set_result(self, data):
+        self.result_data = data
+
+    def get_result(self):
+        return self.result_data or {}
+
+# Cache persistente de análises de cor, indexado pelo hash do conteúdo do PDF
+class PdfAnalysisCache(db.Model):
+    file_hash = db.Column(db.String(32), primary_key=True)  # blake2b (16 bytes) em hex
+    color_type = db.Column(db.String(20), nullable=False)
+    color_pages = db.Column(db.Integer, nullable=False)
+    mono_pages = db.Column(db.Integer, nullable=False)
+    total_pages = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+# Cache persistente das consultas de CEP ao ViaCEP
+class CepCache(db.Model):
+    cep = db.Column(db.String(8), primary_key=True)  # apenas dígitos
+    payload = db.Column(db.Text, nullable=False)  # JSON retornado pelo ViaCEP
+    fetched_at = db.Column(db.DateTime, nullable=False)
+
+# Colunas adicionadas a tabelas já existentes: db.create_all() não altera
+# tabelas, então bancos antigos recebem a coluna via ALTER TABLE
+ADDED_COLUMNS = (
+    ('user', 'cost_details_json', 'TEXT'),
+)
+
+def ensure_columns():
+    """Adiciona as colunas de ADDED_COLUMNS que ainda não existem no banco"""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table, column, ddl_type in ADDED_COLUMNS:
+            existing = {col['name'] for col in inspector.get_columns(table)}
+            if column not in existing:
+                conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl_type}'))
+                logger.info(f"Coluna {table}.{column} adicionada")
+
+# ix_user_cpf duplicava o índice automático do UNIQUE em user.cpf;
+# idx_job_status_created foi substituído pelo índice parcial idx_job_pending_created
+OBSOLETE_INDEXES = ('ix_user_cpf', 'idx_job_status_created', 'ix_user_configured_cost')
+
+def ensure_indexes():
+    """
+    Cria os índices declarados nos modelos que ainda não existem no banco.
+    
+    db.create_all() só cria índices junto com tabelas novas; bancos já
+    existentes recebem aqui os índices adicionados depois (CREATE INDEX só
+    para os que faltam) e perdem os listados em OBSOLETE_INDEXES.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    
+    # Índices que saíram dos modelos: só custam escrita em bancos antigos
+    with db.engine.begin() as conn:
+        for name in OBSOLETE_INDEXES:
+            conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+
+# Consulta de usuário por CPF montada uma única vez; cada request só
+# fornece o parâmetro, sem reconstruir a query do ORM
+_USER_BY_CPF = select(User).where(User.cpf == bindparam('cpf'))
+
+def get_user_by_cpf(cpf):
+    """Retorna o User com este CPF, ou None"""
+    return db.session.execute(_USER_BY_CPF, {'cpf': cpf}).scalar_one_or_none()
+
+# CPF e CEP são tratados só pelos dígitos: "123.456.789-00" e "12345678900"
+# são o mesmo CPF
+_NON_DIGIT = re.compile(r'\D')
+
+def digits_only(value):
+    """Remove tudo que não for dígito (pontos, hífens, espaços)"""
+    # Caso comum (já só dígitos): isdecimal() aceita exatamente o que \d
+    # aceita e evita passar pelo regex e alocar uma nova string
+    if value.isdecimal():
+        return value
+    return _NON_DIGIT.sub('', value)
+
+def find_user_by_cpf_input(cpf_input):
+    """
+    Busca o usuário pelo CPF digitado no formulário, normalizado para dígitos.
+    
+    Cadastros anteriores à normalização guardaram o CPF como foi digitado;
+    só quando a busca pelos dígitos falha o texto original é tentado.
+    """
+    cpf = digits_only(cpf_input)
+    user = get_user_by_cpf(cpf)
+    if user is None and cpf_input != cpf:
+        user = get_user_by_cpf(cpf_input)
+    return user
+
+def get_current_user():
+    """
+    Retorna o User da sessão atual (ou None), consultando o banco no máximo
+    uma vez por request: o resultado fica em g.user.
+    """
+    if 'user' not in g:
+        cpf = session.get('cpf')
+        g.user = get_user_by_cpf(cpf) if cpf else None
+    return g.user
 
 # Função para popular dados iniciais no banco
 def populate_initial_data():
     """Popula dados iniciais dos preços no banco de dados"""
     
-    # Verificar se já existem dados
-    if PaperType.query.count() > 0:
+    # Verificar se já existem dados (basta a primeira linha, sem COUNT(*))
+    if db.session.query(PaperType.id).limit(1).first() is not None:
         return  # Dados já existem
     
     try:
@@ -372,25 +840,31 @@ def populate_initial_data():
             }
         ]
         
-        # Criar tipos de papel
-        for paper_info in paper_data:
-            paper_type = PaperType(
-                name=paper_info['name'],
-                display_name=paper_info['display_name'],
-                description=paper_info['description']
-            )
-            db.session.add(paper_type)
-            db.session.flush()  # Para obter o ID
-            
-            # Criar gramaturas para este papel
-            for weight_info in paper_info['weights']:
-                weight = PaperWeight(
-                    paper_type_id=paper_type.id,
-                    weight=weight_info['weight'],
-                    price_color=weight_info['price_color'],
-                    price_mono=weight_info['price_mono']
-                )
-                db.session.add(weight)
+        # Criar tipos de papel em lote; o próprio INSERT devolve os IDs gerados
+        # (RETURNING, na ordem de paper_data), sem consulta extra
+        paper_ids = db.session.scalars(
+            insert(PaperType).returning(PaperType.id, sort_by_parameter_order=True),
+            [
+                {
+                    'name': paper_info['name'],
+                    'display_name': paper_info['display_name'],
+                    'description': paper_info['description']
+                }
+                for paper_info in paper_data
+            ]
+        ).all()
+        
+        # Criar gramaturas de todos os papéis em lote
+        db.session.bulk_insert_mappings(PaperWeight, [
+            {
+                'paper_type_id': paper_id,
+                'weight': weight_info['weight'],
+                'price_color': weight_info['price_color'],
+                'price_mono': weight_info['price_mono']
+            }
+            for paper_id, paper_info in zip(paper_ids, paper_data)
+            for weight_info in paper_info['weights']
+        ])
         
         # Dados de encadernação baseados no BINDING_PRICES
         binding_data = [
@@ -400,14 +874,7 @@ def populate_initial_data():
             {'name': 'capa-dura', 'display_name': 'Capa dura', 'price': 25.00, 'description': 'Encadernação em capa dura'}
         ]
         
-        for binding_info in binding_data:
-            binding = BindingType(
-                name=binding_info['name'],
-                display_name=binding_info['display_name'],
-                description=binding_info['description'],
-                price=binding_info['price']
-            )
-            db.session.add(binding)
+        db.session.bulk_insert_mappings(BindingType, binding_data)
         
         # Dados de acabamento baseados no FINISHING_PRICES
         finishing_data = [
@@ -417,14 +884,7 @@ def populate_initial_data():
             {'name': 'perfuracao', 'display_name': 'Perfuração', 'price': 1.00, 'description': 'Perfuração para arquivo'}
         ]
         
-        for finishing_info in finishing_data:
-            finishing = FinishingType(
-                name=finishing_info['name'],
-                display_name=finishing_info['display_name'],
-                description=finishing_info['description'],
-                price=finishing_info['price']
-            )
-            db.session.add(finishing)
+        db.session.bulk_insert_mappings(FinishingType, finishing_data)
         
         # SEGURANÇA: Não criar admin padrão - deve ser criado manualmente
         # Para criar admin, execute: flask create-admin
@@ -474,7 +934,7 @@ def create_admin():
     
     try:
         # Criar hash seguro da senha
-        password_hash = generate_password_hash(password)
+        password_hash = hash_admin_password(password)
         
         # Criar admin
         admin = Admin(
@@ -487,7 +947,7 @@ def create_admin():
         db.session.commit()
         
         print(f"✅ Admin '{username}' criado com sucesso!")
-        print("🔒 Senha foi criptografada com Werkzeug password hashing")
+        print("🔒 Senha foi criptografada com Argon2id")
         
     except Exception as e:
         db.session.rollback()
@@ -524,7 +984,7 @@ def reset_admin_password():
     
     try:
         # Atualizar hash da senha
-        admin.password_hash = generate_password_hash(password)
+        admin.password_hash = hash_admin_password(password)
         db.session.commit()
         
         print(f"✅ Senha do admin '{username}' foi resetada com sucesso!")
@@ -533,75 +993,429 @@ def reset_admin_password():
         db.session.rollback()
         print(f"❌ Erro ao resetar senha: {str(e)}")
 
-# Popular dados iniciais na inicialização
-populate_initial_data()
+def init_database():
+    """
+    Cria/atualiza o esquema (tabelas, colunas e índices) e popula os dados
+    iniciais.
+    
+    Roda sob um lock de arquivo, para que vários workers do gunicorn subindo
+    juntos não criem tabelas nem insiram os dados em duplicidade: o primeiro
+    inicializa, os demais esperam e só encontram o banco pronto.
+    """
+    os.makedirs(app.instance_path, exist_ok=True)
+    with open(os.path.join(app.instance_path, 'seed.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            db.create_all()
+            ensure_columns()
+            ensure_indexes()
+            populate_initial_data()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Criar/atualizar as tabelas e popular os dados iniciais"""
+    init_database()
+    print("✅ Banco de dados inicializado")
+
+# Em produção o banco é inicializado uma vez no deploy (flask init-db) e os
+# workers sobem com AUTO_INIT_DB=0, sem refazer a verificação do esquema.
+# Por padrão continua automático, como no ambiente de desenvolvimento
+if os.getenv('AUTO_INIT_DB', '1') == '1':
+    init_database()
+
+# PyMuPDF e pypdf são importados sob demanda: só quem analisa PDFs paga o
+# custo de carregar os módulos (o PyMuPDF traz uma biblioteca nativa grande),
+# e não o worker que só atende o admin ou a API de preços
+@lru_cache(maxsize=None)
+def _get_fitz():
+    import pymupdf  # PyMuPDF para análise de PDFs
+    return pymupdf
+
+@lru_cache(maxsize=None)
+def _get_pypdf():
+    import pypdf
+    return pypdf
+
+# PyMuPDF não é thread-safe: toda análise feita neste processo (requests
+# síncronos de /upload e da API, e as threads de worker) passa por este lock.
+# Reentrante porque analyze_uploaded_pdf() o segura ao abrir o documento e
+# chama analyze_pdf_colors() em seguida. O paralelismo real fica com o pool
+# de processos da estratégia 'parallel'
+_pdf_analysis_lock = threading.RLock()
+
+# Cores de texto consideradas pretas no get_texttrace(), por espaço de cor
+# (Gray, RGB e CMYK). Qualquer outra cor, inclusive cinza, conta como colorida,
+# mantendo o critério "color != 0" usado com get_text("dict")
+BLACK_TEXT_COLORS = frozenset({
+    (0.0,),
+    (0.0, 0.0, 0.0),
+    (0.0, 0.0, 0.0, 1.0),
+})
+_is_black_text_color = BLACK_TEXT_COLORS.__contains__
+_span_color = operator.itemgetter('color')
+
+# Nomes de espaço de cor de imagem (campo 5 de page.get_images()) que já
+# decidem a página sem decodificar a imagem
+COLOR_IMAGE_COLORSPACES = frozenset({'DeviceRGB', 'DeviceCMYK', 'CalRGB'})
+MONO_IMAGE_COLORSPACES = frozenset({'DeviceGray', 'CalGray'})
+
+# Componentes dos espaços de cor nomeados, usados ao resolver /ColorSpace
+# direto do dicionário PDF (ex: base de um /Indexed)
+COLORSPACE_COMPONENTS = {
+    'DeviceGray': 1, 'CalGray': 1,
+    'DeviceRGB': 3, 'CalRGB': 3, 'Lab': 3,
+    'DeviceCMYK': 4,
+}
+_CS_INDIRECT = re.compile(r'^(\d+)\s+\d+\s+R$')
+_CS_NAME = re.compile(r'^\[?\s*/(\w+)\s*\]?$')
+_CS_ICCBASED = re.compile(r'/ICCBased\s*(\d+)\s+\d+\s+R')
+_CS_INDEXED_BASE = re.compile(r'/Indexed\s*(?:/(\w+)|(\d+)\s+\d+\s+R)')
+
+def _colorspace_components(pdf_document, colorspace, depth=0):
+    """
+    Resolve o número de componentes de um /ColorSpace a partir do texto do
+    dicionário PDF, sem decodificar a imagem. Retorna None se não souber.
+    """
+    if depth > 3:
+        return None
+    colorspace = colorspace.strip()
+    
+    # Referência indireta: "12 0 R" -> objeto com o array do espaço de cor
+    match = _CS_INDIRECT.match(colorspace)
+    if match:
+        return _colorspace_components(
+            pdf_document, pdf_document.xref_object(int(match.group(1)), compressed=True), depth + 1)
+    
+    match = _CS_NAME.match(colorspace)
+    if match:
+        return COLORSPACE_COMPONENTS.get(match.group(1))
+    
+    # [/ICCBased 7 0 R]: o número de componentes está em /N do stream ICC
+    match = _CS_ICCBASED.search(colorspace)
+    if match:
+        kind, value = pdf_document.xref_get_key(int(match.group(1)), 'N')
+        return int(value) if kind == 'int' else None
+    
+    # [/Indexed base hival lookup]: vale o espaço de cor base
+    match = _CS_INDEXED_BASE.search(colorspace)
+    if match:
+        base_name, base_xref = match.groups()
+        if base_name:
+            return COLORSPACE_COMPONENTS.get(base_name)
+        return _colorspace_components(pdf_document, f'{base_xref} 0 R', depth + 1)
+    
+    return None
+
+def _image_is_colored(pdf_document, img):
+    """Indica se uma imagem (tupla de page.get_images()) é colorida"""
+    colorspace_name = img[5]
+    if colorspace_name in COLOR_IMAGE_COLORSPACES:
+        return True
+    if colorspace_name in MONO_IMAGE_COLORSPACES:
+        return False
+    
+    xref = img[0]
+    try:
+        # Espaço de cor ambíguo (ICCBased, Indexed...): ler /ColorSpace do
+        # dicionário da imagem, sem decodificar os pixels
+        kind, colorspace = pdf_document.xref_get_key(xref, 'ColorSpace')
+        components = _colorspace_components(pdf_document, colorspace) if kind != 'null' else None
+        if components is not None:
+            # 3 = RGB/Lab, 4 = CMYK
+            return components in (3, 4)
+        
+        # Último recurso (Separation, DeviceN...): extrair a imagem para
+        # obter o número de componentes
+        base_image = pdf_document.extract_image(xref)
+        return base_image.get("colorspace", 1) in (3, 4)
+    except:
+        # Se não conseguir analisar a imagem, assumir que pode ser colorida
+        return True
+
+def _page_has_color(pdf_document, page, image_cache=None):
+    """
+    Indica se uma página tem imagens ou texto coloridos.
+    
+    image_cache ({xref: colorida?}) é compartilhado entre as páginas do mesmo
+    documento, para que imagens repetidas (logos, fundos) sejam analisadas
+    uma única vez.
+    """
+    if image_cache is None:
+        image_cache = {}
+    
+    # Verificar imagens primeiro: get_images() é uma única chamada em C que
+    # já traz o nome do espaço de cor, sem decodificar os pixels
+    for img in page.get_images(full=False):
+        xref = img[0]
+        colored = image_cache.get(xref)
+        if colored is None:
+            colored = image_cache[xref] = _image_is_colored(pdf_document, img)
+        if colored:
+            return True
+    
+    # Verificar texto colorido
+    # get_texttrace() devolve uma lista plana de spans (sem blocos/linhas
+    # aninhados). A varredura roda inteira em C (map + itemgetter +
+    # frozenset.__contains__) e all() para no primeiro span não preto
+    try:
+        text_trace = page.get_texttrace()
+    except:
+        # Se falhar, tratar como página sem texto
+        return False
+    return not all(map(_is_black_text_color, map(_span_color, text_trace)))
+
+def _page_has_color_raster(page):
+    """
+    Indica se uma página é colorida renderizando uma miniatura RGB.
+    
+    Detecta também preenchimentos e traços vetoriais coloridos, que a análise
+    por objetos não vê. Um pixel é cinza quando R == G == B, então a página é
+    monocromática se os planos R, G e B (fatias do buffer de amostras,
+    comparadas em C) forem idênticos. Diferente do modo 'objects', texto
+    cinza conta como monocromático.
+    
+    Com PDF_RASTER_TOLERANCE, pixels quase cinza (ruído de JPEG em
+    digitalizações P&B) também contam como cinza: a tolerância é aplicada a
+    cada cor distinta da miniatura, contadas em C por color_count().
+    """
+    fitz = _get_fitz()
+    pix = page.get_pixmap(matrix=fitz.Matrix(PDF_RASTER_SCALE, PDF_RASTER_SCALE),
+                          colorspace=fitz.csRGB, alpha=False)
+    if PDF_RASTER_TOLERANCE:
+        return any(max(color) - min(color) > PDF_RASTER_TOLERANCE
+                   for color in pix.color_count(colors=True))
+    samples = pix.samples
+    return not (samples[0::3] == samples[1::3] == samples[2::3])
+
+def _count_color_pages(pdf_document, start, end, gc_every=None):
+    """
+    Conta páginas coloridas e monocromáticas no intervalo [start, end).
+    
+    Com gc_every, força uma coleta de lixo a cada N páginas para liberar os
+    objetos de página/texto acumulados em documentos médios.
+    """
+    color_pages = 0
+    mono_pages = 0
+    image_cache = {}
+    raster = PDF_COLOR_DETECTION == 'raster'
+    # Document.pages() percorre as páginas em sequência, sem um __getitem__
+    # (busca na árvore de páginas) por índice
+    for scanned, page in enumerate(pdf_document.pages(start, end), 1):
+        if _page_has_color_raster(page) if raster else _page_has_color(pdf_document, page, image_cache):
+            color_pages += 1
+        else:
+            mono_pages += 1
+        if gc_every and scanned % gc_every == 0:
+            gc.collect()
+    return color_pages, mono_pages
+
+def _count_color_pages_sampled(pdf_document, total_pages, sample_size):
+    """
+    Estima (coloridas, monocromáticas) analisando sample_size páginas
+    igualmente espaçadas (incluindo a primeira e a última) e extrapolando a
+    proporção para o documento inteiro.
+    
+    O custo fica limitado a sample_size páginas, ao preço de uma contagem
+    aproximada: uma página colorida isolada pode não cair na amostra.
+    """
+    page_numbers = sorted({i * (total_pages - 1) // (sample_size - 1) for i in range(sample_size)})
+    image_cache = {}
+    raster = PDF_COLOR_DETECTION == 'raster'
+    sampled_color = 0
+    for page_number in page_numbers:
+        page = pdf_document.load_page(page_number)
+        if _page_has_color_raster(page) if raster else _page_has_color(pdf_document, page, image_cache):
+            sampled_color += 1
+    color_pages = round(sampled_color * total_pages / len(page_numbers))
+    return color_pages, total_pages - color_pages
+
+# ============================================
+# ANÁLISE PARALELA DE PDFs GRANDES
+# ============================================
+
+# PyMuPDF não é thread-safe, mas funciona bem com multiprocessing: cada
+# processo reabre o arquivo e analisa uma faixa de páginas
+PDF_POOL_PROCESSES = min(os.cpu_count() or 1, 4)
+
+# Estratégia de análise por tamanho do documento, do menor para o maior.
+# max_pages=None é o último nível (sem limite superior). Os limites podem ser
+# ajustados por variáveis de ambiente sem mexer no código.
+PARSER_RULES = {
+    'small': {
+        'max_pages': int(os.getenv('PARSER_SMALL_MAX_PAGES', '10')),
+        'strategy': 'sequential',
+    },
+    'medium': {
+        'max_pages': int(os.getenv('PARSER_MEDIUM_MAX_PAGES', '200')),
+        'strategy': 'batched',
+        'gc_every': 50,
+    },
+    'large': {
+        'max_pages': int(os.getenv('PARSER_LARGE_MAX_PAGES', '500')),
+        'strategy': 'parallel',
+        'chunk_size': None,  # automático: ~4 faixas por processo
+    },
+    'xlarge': {
+        'max_pages': None,
+        'strategy': 'parallel',
+        'chunk_size': 500,
+    },
+}
+
+def select_parser_rule(page_count):
+    """Retorna (nome, regra) do PARSER_RULES adequado ao número de páginas"""
+    for name, rule in PARSER_RULES.items():
+        if rule['max_pages'] is None or page_count <= rule['max_pages']:
+            return name, rule
+    return name, rule
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+# Documento mantido aberto em cada processo do pool: faixas seguidas do mesmo
+# arquivo (nível xlarge) reaproveitam o handle em vez de reabrir o PDF
+_worker_document = None
+_worker_document_key = None
+
+def _pdf_worker_init():
+    """Inicializador dos processos do pool: configuração única do PyMuPDF"""
+    global _worker_document, _worker_document_key
+    _worker_document = None
+    _worker_document_key = None
+    _log_without_queue()
+    # Avisos do MuPDF sobre PDFs malformados vão para o log do processo pai,
+    # não para o stderr de cada worker
+    _get_fitz().TOOLS.mupdf_display_errors(False)
+
+def _get_worker_document(filename):
+    global _worker_document, _worker_document_key
+    # Nome + mtime + tamanho: um novo upload com o mesmo nome não reaproveita
+    # o documento antigo
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, stat.st_size)
+    if key != _worker_document_key:
+        if _worker_document is not None:
+            _worker_document.close()
+        _worker_document = _get_fitz().open(filename)
+        _worker_document_key = key
+    return _worker_document
+
+def _scan_pages(filename, start, end):
+    """Worker do pool: conta (coloridas, monocromáticas) em [start, end) do PDF"""
+    return _count_color_pages(_get_worker_document(filename), start, end)
+
+def _scan_pages_range(args):
+    # imap_unordered passa um único argumento
+    return _scan_pages(*args)
+
+def _get_pdf_pool():
+    """Cria o pool de processos uma única vez (lazy) e o reutiliza"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = multiprocessing.Pool(processes=PDF_POOL_PROCESSES, initializer=_pdf_worker_init)
+            atexit.register(_pdf_pool.terminate)
+            logger.info(f"Pool de análise de PDF iniciado com {PDF_POOL_PROCESSES} processos")
+        return _pdf_pool
+
+# Faixas menores que isso não compensam o overhead de despachar a tarefa
+PDF_PARALLEL_MIN_CHUNK = 25
+
+def _scan_pages_parallel(file_path, total_pages, chunk_size=None):
+    """
+    Divide as páginas em faixas e soma as contagens parciais dos workers.
+    
+    Sem chunk_size, gera cerca de 4 faixas por processo: páginas pesadas
+    (imagens, muito texto) costumam ficar agrupadas, e faixas menores
+    distribuem melhor a carga entre os processos. As faixas são consumidas
+    à medida que ficam prontas.
+    """
+    if not chunk_size:
+        chunk_size = max(PDF_PARALLEL_MIN_CHUNK, -(-total_pages // (PDF_POOL_PROCESSES * 4)))
+    ranges = [(file_path, start, min(start + chunk_size, total_pages))
+              for start in range(0, total_pages, chunk_size)]
+    
+    color_pages = 0
+    mono_pages = 0
+    for partial_color, partial_mono in _get_pdf_pool().imap_unordered(_scan_pages_range, ranges):
+        color_pages += partial_color
+        mono_pages += partial_mono
+    return color_pages, mono_pages
+
+def count_pdf_pages_fallback(source):
+    """
+    Conta as páginas com pypdf quando o PyMuPDF não consegue abrir o arquivo.
+    
+    Aceita o caminho do arquivo ou o conteúdo já lido (bytes).
+    
+    Lê o /Count da raiz da árvore de páginas (O(1)) em vez de percorrer todas
+    as páginas; só percorre a árvore se o /Count estiver ausente ou inválido.
+    """
+    with (io.BytesIO(source) if isinstance(source, bytes) else open(source, 'rb')) as pdf_file:
+        pdf_reader = _get_pypdf().PdfReader(pdf_file, strict=False)
+        try:
+            page_count = int(pdf_reader.trailer['/Root']['/Pages']['/Count'])
+        except (KeyError, TypeError, ValueError):
+            page_count = 0
+        if page_count <= 0:
+            page_count = len(pdf_reader.pages)
+        return page_count
+
+def analyze_pdf_colors(source, file_path=None):
+    """Analisa cores em um PDF (ver _analyze_pdf_colors), um documento por vez no processo"""
+    with _pdf_analysis_lock:
+        return _analyze_pdf_colors(source, file_path)
 
-def analyze_pdf_colors(file_path):
-    """Analisa cores em um PDF e retorna estatísticas"""
+def _analyze_pdf_colors(source, file_path=None):
+    """
+    Analisa cores em um PDF e retorna estatísticas.
+
+    Aceita o caminho do arquivo, o conteúdo já lido (bytes) ou um fitz.Document
+    já aberto, permitindo que quem já abriu ou leu o documento (ex: upload)
+    reutilize o mesmo parse. file_path indica o arquivo em disco quando source
+    são bytes (usado pela análise paralela).
+    """
+    fitz = _get_fitz()
     total_pages = 0  # Inicializar para evitar UnboundLocalError
+    owns_document = not isinstance(source, fitz.Document)
+    if file_path is None and not isinstance(source, bytes):
+        file_path = source if owns_document else source.name
+    pdf_document = None
     try:
-        # Abrir o PDF com PyMuPDF
-        pdf_document = fitz.open(file_path)
+        # Abrir o PDF com PyMuPDF (apenas se ainda não estiver aberto)
+        if isinstance(source, bytes):
+            pdf_document = fitz.open(stream=source, filetype='pdf')
+        else:
+            pdf_document = fitz.open(source) if owns_document else source
         
-        color_pages = 0
-        mono_pages = 0
-        total_pages = len(pdf_document)
+        total_pages = pdf_document.page_count
         
-        for page_num in range(total_pages):
-            page = pdf_document[page_num]
-            
-            # Verificar imagens na página
-            has_color = False
-            
-            # Verificar texto colorido
+        # Escolher a estratégia pelo tamanho do documento. O pool reabre o
+        # arquivo, então só vale quando o documento veio de um arquivo em disco
+        rule_name, rule = select_parser_rule(total_pages)
+        color_counts = None
+        if PDF_SAMPLE_PAGES > 1 and total_pages > PDF_SAMPLE_PAGES:
+            # Modo amostragem (opcional): custo limitado a PDF_SAMPLE_PAGES páginas
+            rule_name = 'sampled'
+            color_counts = _count_color_pages_sampled(pdf_document, total_pages, PDF_SAMPLE_PAGES)
+        elif rule['strategy'] == 'parallel':
             try:
-                text_dict = page.get_text("dict")
-            except:
-                # Se falhar, usar método alternativo
-                text_dict = {"blocks": []}
-            for block in text_dict["blocks"]:
-                if "lines" in block:
-                    for line in block["lines"]:
-                        for span in line["spans"]:
-                            # Verificar cor do texto (RGB)
-                            color = span.get("color", 0)
-                            if color != 0:  # 0 = preto, outros valores = colorido
-                                has_color = True
-                                break
-                        if has_color:
-                            break
-                    if has_color:
-                        break
-            
-            # Verificar imagens na página
-            if not has_color:
-                image_list = page.get_images()
-                for img_index, img in enumerate(image_list):
-                    try:
-                        # Extrair dados da imagem
-                        xref = img[0]
-                        base_image = pdf_document.extract_image(xref)
-                        
-                        # Verificar se é colorida baseado no espaço de cores
-                        colorspace = base_image.get("colorspace", 1)
-                        if colorspace == 3:  # RGB colorido
-                            has_color = True
-                            break
-                        elif colorspace == 4:  # CMYK colorido  
-                            has_color = True
-                            break
-                    except:
-                        # Se não conseguir analisar a imagem, assumir que pode ser colorida
-                        has_color = True
-                        break
-            
-            # Contar páginas
-            if has_color:
-                color_pages += 1
-            else:
-                mono_pages += 1
-        
-        pdf_document.close()
+                if file_path and os.path.exists(file_path):
+                    color_counts = _scan_pages_parallel(file_path, total_pages, rule.get('chunk_size'))
+                elif isinstance(source, bytes):
+                    # PDF só em memória: o pool precisa de um arquivo para reabrir
+                    with secure_temp_pdf_file() as temp_path:
+                        with open(temp_path, 'wb') as temp_file:
+                            temp_file.write(source)
+                        color_counts = _scan_pages_parallel(temp_path, total_pages, rule.get('chunk_size'))
+            except Exception as e:
+                logger.warning(f"Análise paralela falhou, usando sequencial: {e}")
+        if color_counts is None:
+            color_counts = _count_color_pages(pdf_document, 0, total_pages, rule.get('gc_every'))
+        logger.debug(f"Análise de cores: {total_pages} páginas, estratégia {rule_name}")
+        color_pages, mono_pages = color_counts
         
         # Determinar tipo geral
         if color_pages == 0:
@@ -619,139 +1433,339 @@ def analyze_pdf_colors(file_path):
         }
         
     except Exception as e:
-        # Se falhar na análise, tentar obter total de páginas via PyPDF2 como fallback
-        try:
-            with open(file_path, 'rb') as f:
-                pdf_reader = PyPDF2.PdfReader(f)
-                total_pages = len(pdf_reader.pages)
-        except:
-            total_pages = 1  # Valor seguro se tudo falhar
+        # Se falhar na análise, tentar obter total de páginas via pypdf como fallback
+        # (desnecessário se o PyMuPDF já abriu o documento e contou as páginas)
+        if not total_pages:
+            try:
+                total_pages = count_pdf_pages_fallback(source if isinstance(source, bytes) else file_path)
+            except:
+                total_pages = 1  # Valor seguro se tudo falhar
         
-        # Assumir monocromático como seguro
+        # Assumir monocromático como seguro. 'fallback' marca o resultado
+        # como estimativa: não vai para o cache (ver color_stats_cacheable)
         return {
             "color_type": "monocromatico", 
             "color_pages": 0,
             "mono_pages": total_pages,
-            "total_pages": total_pages
+            "total_pages": total_pages,
+            "fallback": True
         }
+    
+    finally:
+        # Fechar apenas documentos abertos aqui; quem passou o Document é dono dele
+        if owns_document and pdf_document is not None:
+            pdf_document.close()
+
+# ============================================
+# CACHE DE ANÁLISE DE CORES POR HASH DO ARQUIVO
+# ============================================
+
+PDF_ANALYSIS_MEMORY_CACHE_SIZE = int(os.getenv('PDF_ANALYSIS_MEMORY_CACHE_SIZE', '256'))
+# Validade das linhas de pdf_analysis_cache (mais antigas são refeitas e
+# removidas por `flask purge-analysis-cache`)
+PDF_ANALYSIS_CACHE_TTL = timedelta(days=int(os.getenv('PDF_ANALYSIS_CACHE_TTL_DAYS', '30')))
+
+# LRU em memória na frente da tabela pdf_analysis_cache (compartilhado entre
+# as threads de request e o worker assíncrono, por isso protegido por lock):
+# hash -> (created_at, análise), com a mesma validade da tabela
+_pdf_analysis_memo = collections.OrderedDict()
+_pdf_analysis_memo_lock = threading.Lock()
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+_PDF_MAGIC = b'%PDF-'
+
+def _new_file_digest():
+    return hashlib.blake2b(digest_size=16)
+
+def compute_file_hash(file_path):
+    """Calcula o hash blake2b (16 bytes, hex) do conteúdo de um arquivo"""
+    with open(file_path, 'rb') as f:
+        return hashlib.file_digest(f, _new_file_digest).hexdigest()
+
+def has_pdf_extension(filename):
+    """Verifica a extensão .pdf olhando só o sufixo, sem copiar o nome inteiro"""
+    _, dot, ext = filename.rpartition('.')
+    return bool(dot) and len(ext) == 3 and ext.lower() == 'pdf'
+
+def read_pdf_first_chunk(stream):
+    """
+    Lê o primeiro bloco (1 MiB) do upload e valida o header PDF, antes de
+    qualquer gravação em disco.
+    
+    Returns:
+        bytes: o bloco lido, ou None se o arquivo não começar com o header PDF
+    """
+    chunk = stream.read(UPLOAD_CHUNK_SIZE)
+    return chunk if chunk.startswith(_PDF_MAGIC) else None
+
+def save_pdf_upload(first_chunk, stream, file_path, max_size=MAX_UPLOAD_SIZE):
+    """
+    Copia o upload para o disco em blocos de 1 MiB, numa única passada,
+    começando pelo bloco já lido em read_pdf_first_chunk(). Cada bloco
+    alimenta o hash.
+    
+    Returns:
+        str: hash do conteúdo (mesmo formato de compute_file_hash), ou None
+        se o arquivo passar de max_size (o arquivo parcial é removido)
+    """
+    digest = _new_file_digest()
+    size = 0
+    chunk = first_chunk
+    with open(file_path, 'wb') as out:
+        while chunk:
+            size += len(chunk)
+            if size > max_size:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+    if size > max_size:
+        os.remove(file_path)
+        return None
+    return digest.hexdigest()
+
+def _remember_color_stats(file_hash, created_at, color_stats):
+    with _pdf_analysis_memo_lock:
+        _pdf_analysis_memo[file_hash] = (created_at, color_stats)
+        _pdf_analysis_memo.move_to_end(file_hash)
+        while len(_pdf_analysis_memo) > PDF_ANALYSIS_MEMORY_CACHE_SIZE:
+            _pdf_analysis_memo.popitem(last=False)
+
+def get_cached_color_stats(file_hash):
+    """Retorna a análise de cores já feita para este conteúdo, ou None"""
+    valid_after = datetime.now() - PDF_ANALYSIS_CACHE_TTL
+    with _pdf_analysis_memo_lock:
+        entry = _pdf_analysis_memo.get(file_hash)
+        if entry is not None:
+            if entry[0] >= valid_after:
+                _pdf_analysis_memo.move_to_end(file_hash)
+                return dict(entry[1])
+            del _pdf_analysis_memo[file_hash]
+    
+    cached = db.session.get(PdfAnalysisCache, file_hash)
+    if cached is None or (cached.created_at is not None and
+                          cached.created_at < valid_after):
+        return None
+    
+    color_stats = {
+        'color_type': cached.color_type,
+        'color_pages': cached.color_pages,
+        'mono_pages': cached.mono_pages,
+        'total_pages': cached.total_pages
+    }
+    # Linhas antigas sem created_at: a validade em memória conta a partir de agora
+    _remember_color_stats(file_hash, cached.created_at or datetime.now(), color_stats)
+    return dict(color_stats)
+
+# INSERT ... ON CONFLICT DO UPDATE dos bancos suportados
+_UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+def _upsert_color_stats_row(values):
+    """
+    Grava a linha de pdf_analysis_cache sem colidir com outra gravação do
+    mesmo hash (dois uploads simultâneos do mesmo PDF): a segunda apenas
+    sobrescreve a primeira, sem IntegrityError na transação de quem chamou.
+    """
+    make_insert = _UPSERT_INSERTS.get(db.engine.dialect.name)
+    if make_insert is None:
+        db.session.merge(PdfAnalysisCache(**values))
+        return
+    stmt = make_insert(PdfAnalysisCache).values(**values)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=[PdfAnalysisCache.file_hash],
+        set_={name: stmt.excluded[name] for name in values if name != 'file_hash'}
+    ))
+
+def store_color_stats(file_hash, color_stats, commit=True):
+    """
+    Guarda a análise de cores no LRU em memória e na tabela de cache.
+    
+    Com commit=False a linha só entra na sessão e é gravada no commit de
+    quem chamou (mesma transação das demais alterações do request).
+    """
+    created_at = datetime.now()  # regravar uma linha vencida renova a validade
+    _remember_color_stats(file_hash, created_at, dict(color_stats))
+    values = {
+        'file_hash': file_hash,
+        'color_type': color_stats['color_type'],
+        'color_pages': color_stats['color_pages'],
+        'mono_pages': color_stats['mono_pages'],
+        'total_pages': color_stats['total_pages'],
+        'created_at': created_at,
+    }
+    if not commit:
+        _upsert_color_stats_row(values)
+        return
+    try:
+        _upsert_color_stats_row(values)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"Falha ao gravar cache de análise {file_hash}: {e}")
+
+def color_stats_cacheable(color_stats):
+    """
+    False para o resultado de fallback do analyze_pdf_colors() (falha na
+    análise): uma falha transitória não pode precificar o arquivo por
+    PDF_ANALYSIS_CACHE_TTL
+    """
+    return not color_stats.get('fallback')
+
+def analyze_pdf_colors_cached(source, file_hash=None):
+    """
+    analyze_pdf_colors() com cache por hash do conteúdo: o mesmo PDF enviado
+    de novo (upload ou URL) não é analisado outra vez.
+    
+    source é o caminho do arquivo ou o PDF já em memória (bytes).
+    file_hash é o hash já calculado durante o download: nesse caso o arquivo
+    não é lido para a memória; num cache miss o PyMuPDF abre direto do disco
+    (ou dos bytes recebidos). Sem ele, o arquivo é lido do disco uma única
+    vez e os mesmos bytes alimentam o hash e o PyMuPDF.
+    """
+    if file_hash is not None:
+        color_stats = get_cached_color_stats(file_hash)
+        if color_stats is None:
+            color_stats = analyze_pdf_colors(source)
+            if color_stats_cacheable(color_stats):
+                store_color_stats(file_hash, color_stats)
+        return color_stats
+    
+    file_path = source
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    digest = _new_file_digest()
+    digest.update(data)
+    file_hash = digest.hexdigest()
+    color_stats = get_cached_color_stats(file_hash)
+    if color_stats is None:
+        color_stats = analyze_pdf_colors(data, file_path=file_path)
+        if color_stats_cacheable(color_stats):
+            store_color_stats(file_hash, color_stats)
+    return color_stats
 
 def calculate_estimated_cost(color_pages, mono_pages):
     """Calcula custo estimado baseado na quantidade de páginas (básico)"""
-    # Preços básicos exemplo (em reais)
-    PRICE_COLOR = 0.50    # R$ 0,50 por página colorida
-    PRICE_MONO = 0.10     # R$ 0,10 por página monocromática
+    # Preços básicos exemplo (em centavos)
+    PRICE_COLOR = 50    # R$ 0,50 por página colorida
+    PRICE_MONO = 10     # R$ 0,10 por página monocromática
     
     color_cost = color_pages * PRICE_COLOR
     mono_cost = mono_pages * PRICE_MONO
     total_cost = color_cost + mono_cost
     
-    return round(total_cost, 2)
+    return total_cost / 100
 
 # Tabelas de preços para configuração avançada
+# Preços de fallback em centavos inteiros: somas exatas, sem arredondamento
+# de ponto flutuante (a conversão para reais só acontece na resposta).
+# Cada gramatura guarda a tupla (preço colorido, preço P&B)
 PAPER_PRICES = {
     'sulfite': {
-        75: {'color': 0.45, 'mono': 0.08},
-        90: {'color': 0.50, 'mono': 0.10}, 
-        120: {'color': 0.65, 'mono': 0.15}
+        75: (45, 8),
+        90: (50, 10), 
+        120: (65, 15)
     },
     'couche': {
-        90: {'color': 0.70, 'mono': 0.20},
-        115: {'color': 0.85, 'mono': 0.25},
-        150: {'color': 1.10, 'mono': 0.35}
+        90: (70, 20),
+        115: (85, 25),
+        150: (110, 35)
     },
     'reciclado': {
-        75: {'color': 0.40, 'mono': 0.07},
-        90: {'color': 0.45, 'mono': 0.08}
+        75: (40, 7),
+        90: (45, 8)
     }
 }
 
+# Versões achatadas do PAPER_PRICES, montadas uma vez na importação:
+# (tipo, gramatura) -> (preço colorido, preço P&B) resolve o preço em uma
+# única consulta, e as gramaturas de cada papel ficam em tupla ordenada
+PAPER_PRICES_FLAT = {
+    (paper_type, weight): prices
+    for paper_type, weights in PAPER_PRICES.items()
+    for weight, prices in weights.items()
+}
+WEIGHTS_BY_PAPER = {
+    paper_type: tuple(sorted(weights))
+    for paper_type, weights in PAPER_PRICES.items()
+}
+
+def nearest_weight(sorted_weights, weight):
+    """Gramatura mais próxima em uma tupla ordenada (busca binária; empate fica com a menor)"""
+    i = bisect.bisect_left(sorted_weights, weight)
+    if i == 0:
+        return sorted_weights[0]
+    if i == len(sorted_weights):
+        return sorted_weights[-1]
+    below, above = sorted_weights[i - 1], sorted_weights[i]
+    return above if above - weight < weight - below else below
+
 BINDING_PRICES = {
-    'grampo': 2.00,
-    'spiral': 5.00,
-    'wire-o': 8.00,
-    'capa-dura': 25.00
+    'grampo': 200,
+    'spiral': 500,
+    'wire-o': 800,
+    'capa-dura': 2500
 }
 
 FINISHING_PRICES = {
-    'laminacao': 3.00,
-    'verniz': 2.50,
-    'dobra': 1.50,
-    'perfuracao': 1.00
+    'laminacao': 300,
+    'verniz': 250,
+    'dobra': 150,
+    'perfuracao': 100
 }
 
+def to_cents(price):
+    """Converte um preço em reais (float do banco) para centavos inteiros"""
+    return round(price * 100)
+
+def finishing_cost_cents(finishing_prices, finishing):
+    """Soma, em centavos, os acabamentos de uma lista separada por vírgulas"""
+    if not finishing:
+        return 0
+    return sum(finishing_prices.get(option.strip(), 0) for option in finishing.split(','))
+
+def build_cost_details(pages_cents, binding_cents, finishing_cents, copy_quantity):
+    """Monta o detalhamento de custo a partir de valores em centavos inteiros"""
+    cost_per_copy = pages_cents + binding_cents + finishing_cents
+    return {
+        'pages_cost': pages_cents / 100,
+        'binding_cost': binding_cents / 100,
+        'finishing_cost': finishing_cents / 100,
+        'cost_per_copy': cost_per_copy / 100,
+        'total_cost': cost_per_copy * copy_quantity / 100,
+        'copy_quantity': copy_quantity
+    }
+
+@lru_cache(maxsize=4096)
+def _calculate_advanced_cost_cached(price_generation, color_pages, mono_pages, paper_type,
+                                    paper_weight, binding_type, finishing_key, copy_quantity):
+    """
+    Memoização de calculate_advanced_cost. price_generation faz parte da
+    chave: a cada recarga das tabelas (alteração no admin ou TTL vencido) as
+    entradas antigas deixam de ser consultadas.
+    """
+    return _price_order(get_price_tables(), color_pages, mono_pages, paper_type,
+                        paper_weight, binding_type, ','.join(finishing_key), copy_quantity)
+
 def calculate_advanced_cost(color_pages, mono_pages, paper_type='sulfite', 
                           paper_weight=90, binding_type='grampo', 
                           finishing=None, copy_quantity=1):
     """Calcula custo avançado baseado nos dados do banco de dados"""
     
     try:
-        # Buscar preço do papel
-        paper_type_obj = PaperType.query.filter_by(name=paper_type, active=True).first()
-        if not paper_type_obj:
-            # Fallback para sulfite se não encontrar
-            paper_type_obj = PaperType.query.filter_by(name='sulfite', active=True).first()
-        
-        if not paper_type_obj:
-            # Fallback final usando preços hardcoded se não houver dados no banco
-            return calculate_advanced_cost_fallback(color_pages, mono_pages, paper_type, 
-                                                 paper_weight, binding_type, finishing, copy_quantity)
-        
-        # Buscar gramatura específica
-        paper_weight_obj = PaperWeight.query.filter_by(
-            paper_type_id=paper_type_obj.id, 
-            weight=paper_weight,
-            active=True
-        ).first()
-        
-        if not paper_weight_obj:
-            # Buscar gramatura mais próxima
-            available_weights = PaperWeight.query.filter_by(
-                paper_type_id=paper_type_obj.id,
-                active=True
-            ).all()
-            
-            if available_weights:
-                paper_weight_obj = min(available_weights, 
-                                     key=lambda x: abs(x.weight - paper_weight))
-        
-        if not paper_weight_obj:
-            return calculate_advanced_cost_fallback(color_pages, mono_pages, paper_type, 
-                                                 paper_weight, binding_type, finishing, copy_quantity)
-        
-        # Calcular custo das páginas
-        pages_cost = (color_pages * paper_weight_obj.price_color) + (mono_pages * paper_weight_obj.price_mono)
-        
-        # Buscar custo de encadernação
-        binding_obj = BindingType.query.filter_by(name=binding_type, active=True).first()
-        binding_cost = binding_obj.price if binding_obj else 0
-        
-        # Calcular custo de acabamento
-        finishing_cost = 0
-        if finishing:
-            finishing_options = finishing.split(',')
-            for option in finishing_options:
-                option = option.strip()
-                finishing_obj = FinishingType.query.filter_by(name=option, active=True).first()
-                if finishing_obj:
-                    finishing_cost += finishing_obj.price
-        
-        # Custo por exemplar
-        cost_per_copy = pages_cost + binding_cost + finishing_cost
-        
-        # Custo total considerando quantidade
-        total_cost = cost_per_copy * copy_quantity
-        
-        return {
-            'pages_cost': round(pages_cost, 2),
-            'binding_cost': round(binding_cost, 2),
-            'finishing_cost': round(finishing_cost, 2),
-            'cost_per_copy': round(cost_per_copy, 2),
-            'total_cost': round(total_cost, 2),
-            'copy_quantity': copy_quantity
-        }
+        # Tabelas de preço em memória (recarregadas do banco só depois de
+        # alterações no admin): o cálculo vira consultas a dicts. Orçamentos
+        # repetidos saem do cache; os acabamentos viram uma tupla ordenada,
+        # já que a ordem não altera o preço
+        finishing_key = tuple(sorted(option.strip() for option in finishing.split(','))) if finishing else ()
+        get_price_tables()  # recarrega antes de ler a geração, se vencidas
+        cost_details = _calculate_advanced_cost_cached(
+            _PRICE_CACHE['generation'], color_pages, mono_pages, paper_type,
+            paper_weight, binding_type, finishing_key, copy_quantity)
+        # Cópia: quem chama pode alterar o dict sem afetar o cache
+        return dict(cost_details)
         
     except Exception as e:
-        print(f"Erro no cálculo avançado: {str(e)}")
+        logger.warning(f"Erro no cálculo avançado: {e}")
         # Fallback para função com preços hardcoded
         return calculate_advanced_cost_fallback(color_pages, mono_pages, paper_type, 
                                              paper_weight, binding_type, finishing, copy_quantity)
@@ -761,51 +1775,270 @@ def calculate_advanced_cost_fallback(color_pages, mono_pages, paper_type='sulfit
                                    finishing=None, copy_quantity=1):
     """Função de fallback usando preços hardcoded (compatibilidade)"""
     
-    # Validar se o tipo de papel e gramatura existem
-    if paper_type not in PAPER_PRICES:
-        paper_type = 'sulfite'
-    
-    if paper_weight not in PAPER_PRICES[paper_type]:
+    # Preços por página baseados no papel (caso comum: uma única consulta)
+    page_prices = PAPER_PRICES_FLAT.get((paper_type, paper_weight))
+    if page_prices is None:
+        # Validar se o tipo de papel existe
+        if paper_type not in WEIGHTS_BY_PAPER:
+            paper_type = 'sulfite'
+        page_prices = PAPER_PRICES_FLAT.get((paper_type, paper_weight))
+    if page_prices is None:
         # Usar gramatura mais próxima disponível
-        available_weights = list(PAPER_PRICES[paper_type].keys())
-        paper_weight = min(available_weights, key=lambda x: abs(x - paper_weight))
+        paper_weight = nearest_weight(WEIGHTS_BY_PAPER[paper_type], paper_weight)
+        page_prices = PAPER_PRICES_FLAT[(paper_type, paper_weight)]
+    price_color, price_mono = page_prices
     
-    # Preços por página baseados no papel
-    page_prices = PAPER_PRICES[paper_type][paper_weight]
-    
-    # Calcular custo das páginas
-    pages_cost = (color_pages * page_prices['color']) + (mono_pages * page_prices['mono'])
+    # Calcular custo das páginas (em centavos)
+    pages_cents = (color_pages * price_color) + (mono_pages * price_mono)
     
     # Adicionar custo de encadernação
-    binding_cost = BINDING_PRICES.get(binding_type, 0)
+    binding_cents = BINDING_PRICES.get(binding_type, 0)
     
     # Adicionar custo de acabamento
-    finishing_cost = 0
-    if finishing:
-        finishing_options = finishing.split(',')
-        for option in finishing_options:
-            option = option.strip()
-            finishing_cost += FINISHING_PRICES.get(option, 0)
+    finishing_cents = finishing_cost_cents(FINISHING_PRICES, finishing)
+    
+    # Custo por exemplar e total considerando quantidade
+    return build_cost_details(pages_cents, binding_cents, finishing_cents, copy_quantity)
+
+# ============================================
+# RECÁLCULO EM LOTE DE PEDIDOS
+# ============================================
+
+def load_price_tables():
+    """
+    Carrega as tabelas de preço ativas do banco em dicts (preços em centavos),
+    para precificar muitos pedidos sem consultas por pedido. Papéis e
+    gramaturas vêm de um único LEFT JOIN (papel ativo sem gramatura ativa
+    entra com um dict vazio); encadernações e acabamentos, de uma consulta
+    cada.
     
-    # Custo por exemplar
-    cost_per_copy = pages_cost + binding_cost + finishing_cost
+    As tabelas retornadas são somente leitura (MappingProxyType): ficam
+    compartilhadas entre threads no cache sem risco de alguém alterá-las.
+    """
+    paper_weights = {}
+    rows = db.session.execute(
+        select(PaperType.name, PaperWeight.weight, PaperWeight.price_color, PaperWeight.price_mono)
+        .select_from(PaperType)
+        .outerjoin(PaperWeight, (PaperWeight.paper_type_id == PaperType.id) & (PaperWeight.active == True))
+        .where(PaperType.active == True)
+        .order_by(PaperWeight.id)
+    )
+    for name, weight, price_color, price_mono in rows:
+        weights = paper_weights.setdefault(name, {})
+        if weight is not None:
+            weights[weight] = (to_cents(price_color), to_cents(price_mono))
     
-    # Custo total considerando quantidade
-    total_cost = cost_per_copy * copy_quantity
+    bindings = db.session.execute(
+        select(BindingType.name, BindingType.price).where(BindingType.active == True)
+    )
+    finishings = db.session.execute(
+        select(FinishingType.name, FinishingType.price).where(FinishingType.active == True)
+    )
+    return MappingProxyType({
+        'paper_weights': MappingProxyType({
+            name: MappingProxyType(weights) for name, weights in paper_weights.items()
+        }),
+        # Gramaturas ordenadas por papel, para a busca da mais próxima
+        'sorted_weights': MappingProxyType({
+            name: tuple(sorted(weights)) for name, weights in paper_weights.items()
+        }),
+        'bindings': MappingProxyType({name: to_cents(price) for name, price in bindings}),
+        'finishings': MappingProxyType({name: to_cents(price) for name, price in finishings}),
+    })
+
+# Cache em processo das tabelas de preço. 'version' é incrementada a cada
+# alteração feita pelo admin; as tabelas são recarregadas quando a versão
+# carregada fica para trás. A invalidação só alcança o processo que atendeu
+# o admin: os demais workers (gunicorn) recarregam após PRICE_CACHE_TTL.
+# 'generation' muda a cada recarga, por qualquer motivo, e é a chave do
+# cache de orçamentos
+PRICE_CACHE_TTL = float(os.getenv('PRICE_CACHE_TTL', '60'))  # segundos
+_PRICE_CACHE = {'version': 0, 'loaded_version': None, 'expires_at': 0.0, 'tables': None,
+                'generation': 0}
+_price_cache_lock = threading.Lock()
+
+def _price_cache_is_fresh():
+    return (_PRICE_CACHE['loaded_version'] == _PRICE_CACHE['version']
+            and time.monotonic() < _PRICE_CACHE['expires_at'])
+
+def get_price_tables():
+    """Retorna as tabelas de preço em cache, recarregando se estiverem desatualizadas"""
+    # Caminho comum sem lock: as tabelas são imutáveis e 'tables' é gravado
+    # antes de 'loaded_version'
+    if _price_cache_is_fresh():
+        return _PRICE_CACHE['tables']
+    with _price_cache_lock:
+        if not _price_cache_is_fresh():
+            version = _PRICE_CACHE['version']
+            _PRICE_CACHE['tables'] = load_price_tables()
+            _PRICE_CACHE['generation'] += 1
+            _PRICE_CACHE['expires_at'] = time.monotonic() + PRICE_CACHE_TTL
+            _PRICE_CACHE['loaded_version'] = version
+        return _PRICE_CACHE['tables']
+
+def invalidate_price_cache():
+    """Marca as tabelas de preço como desatualizadas (chamar após alterar preços)"""
+    with _price_cache_lock:
+        _PRICE_CACHE['version'] += 1
+
+# Carregar as tabelas já na subida (depois do seed), para o primeiro
+# orçamento não pagar as consultas
+try:
+    get_price_tables()
+except Exception as e:
+    logger.warning(f"Tabelas de preço não pré-carregadas: {e}")
+
+def _price_order(tables, color_pages, mono_pages, paper_type, paper_weight,
+                 binding_type, finishing, copy_quantity):
+    """Mesmo cálculo de calculate_advanced_cost, usando tabelas já carregadas"""
+    # Papel inexistente ou inativo usa a tabela do sulfite; um papel ativo sem
+    # gramaturas ativas (ou sulfite sem gramaturas) cai nos preços fixos do
+    # papel pedido
+    price_table = paper_type if paper_type in tables['paper_weights'] else 'sulfite'
+    weights = tables['paper_weights'].get(price_table)
+    if not weights:
+        return calculate_advanced_cost_fallback(color_pages, mono_pages, paper_type,
+                                                paper_weight, binding_type, finishing, copy_quantity)
     
-    return {
-        'pages_cost': round(pages_cost, 2),
-        'binding_cost': round(binding_cost, 2),
-        'finishing_cost': round(finishing_cost, 2),
-        'cost_per_copy': round(cost_per_copy, 2),
-        'total_cost': round(total_cost, 2),
-        'copy_quantity': copy_quantity
-    }
+    prices = weights.get(paper_weight)
+    if prices is None:
+        # Gramatura mais próxima
+        prices = weights[nearest_weight(tables['sorted_weights'][price_table], paper_weight)]
+    price_color, price_mono = prices
+    
+    pages_cents = (color_pages * price_color) + (mono_pages * price_mono)
+    binding_cents = tables['bindings'].get(binding_type, 0)
+    finishing_cents = finishing_cost_cents(tables['finishings'], finishing)
+    
+    return build_cost_details(pages_cents, binding_cents, finishing_cents, copy_quantity)
+
+def calculate_advanced_cost_bulk(orders, tables=None):
+    """
+    Calcula o custo de vários pedidos de uma vez.
+    
+    Args:
+        orders: iterável de dicts com os mesmos parâmetros de calculate_advanced_cost
+        tables: tabelas de load_price_tables() (as do cache se omitidas)
+        
+    Returns:
+        list: um dict de custo por pedido, na mesma ordem
+    """
+    if tables is None:
+        tables = get_price_tables()
+    
+    return [
+        _price_order(
+            tables,
+            order['color_pages'], order['mono_pages'],
+            order.get('paper_type') or 'sulfite', order.get('paper_weight') or 90,
+            order.get('binding_type') or 'grampo', order.get('finishing'),
+            order.get('copy_quantity') or 1
+        )
+        for order in orders
+    ]
+
+@app.cli.command('reprice-orders')
+def reprice_orders():
+    """Recalcular o custo total de todos os pedidos configurados"""
+    rows = db.session.execute(
+        select(User.id, User.print_type, User.color_pages, User.mono_pages,
+               User.paper_type, User.paper_weight, User.binding_type,
+               User.finishing, User.copy_quantity)
+        .where(User.order_configured == True)
+    ).all()
+    
+    orders = []
+    for row in rows:
+        color_pages = row.color_pages or 0
+        mono_pages = row.mono_pages or 0
+        # Mesma regra de páginas por tipo de impressão usada no carrinho
+        if row.print_type == 'color':
+            color_pages, mono_pages = color_pages + mono_pages, 0
+        elif row.print_type == 'mono':
+            color_pages, mono_pages = 0, color_pages + mono_pages
+        orders.append({
+            'color_pages': color_pages,
+            'mono_pages': mono_pages,
+            'paper_type': row.paper_type,
+            'paper_weight': row.paper_weight,
+            'binding_type': row.binding_type,
+            'finishing': row.finishing,
+            'copy_quantity': row.copy_quantity
+        })
+    
+    costs = calculate_advanced_cost_bulk(orders)
+    
+    try:
+        db.session.bulk_update_mappings(User, [
+            {'id': row.id, 'total_cost': cost['total_cost'],
+             'cost_details_json': orjson.dumps(cost).decode()}
+            for row, cost in zip(rows, costs)
+        ])
+        db.session.commit()
+        print(f"✅ {len(rows)} pedidos recalculados")
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Erro ao recalcular pedidos: {str(e)}")
+
+@app.cli.command('purge-analysis-cache')
+def purge_analysis_cache():
+    """Remover análises em cache mais antigas que PDF_ANALYSIS_CACHE_TTL_DAYS (rodar diariamente)"""
+    cutoff = datetime.now() - PDF_ANALYSIS_CACHE_TTL
+    try:
+        removed = db.session.execute(
+            delete(PdfAnalysisCache).where(PdfAnalysisCache.created_at < cutoff)
+        ).rowcount
+        db.session.commit()
+        print(f"✅ {removed} análises vencidas removidas do cache")
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Erro ao limpar cache de análises: {str(e)}")
 
 # ============================================
 # SISTEMA ADMINISTRATIVO
 # ============================================
 
+# Hash da senha de um admin ativo. Os hashes não ficam em cache no processo:
+# um reset de senha via CLI (outro processo) vale imediatamente
+_ADMIN_PASSWORD_HASH = select(Admin.password_hash).where(
+    Admin.username == bindparam('username'), Admin.active == True
+)
+
+# Senhas de admin em Argon2id (argon2-cffi, implementação em C). Hashes
+# antigos do Werkzeug continuam válidos e são convertidos no próximo login
+_admin_password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+# Hash de uma senha aleatória, com o mesmo custo dos reais, para verificar
+# logins de usuário inexistente. Calculado já na importação: nenhum request
+# paga um hash a mais (o que denunciaria que o usuário não existe)
+_DUMMY_PASSWORD_HASH = _admin_password_hasher.hash(uuid.uuid4().hex)
+
+# Cada verificação usa 64MB e ~2 núcleos: limitar quantas rodam ao mesmo
+# tempo para que uma rajada de tentativas de login não esgote CPU/memória
+# dos workers. Quem não consegue vaga em ADMIN_LOGIN_WAIT segundos recebe 429
+ADMIN_LOGIN_MAX_CONCURRENT = int(os.getenv('ADMIN_LOGIN_MAX_CONCURRENT', '4'))
+ADMIN_LOGIN_WAIT = 2  # segundos
+_password_verify_slots = threading.BoundedSemaphore(ADMIN_LOGIN_MAX_CONCURRENT)
+
+def hash_admin_password(password):
+    return _admin_password_hasher.hash(password)
+
+def verify_admin_password(password_hash, password):
+    """
+    Confere a senha contra o hash armazenado (Argon2id ou Werkzeug legado).
+    
+    Returns:
+        tuple: (senha_ok, precisa_rehash)
+    """
+    if not password_hash.startswith('$argon2'):
+        # Hash legado do Werkzeug: após um login válido vira Argon2id
+        ok = check_password_hash(password_hash, password)
+        return ok, ok
+    try:
+        _admin_password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False, False
+    return True, _admin_password_hasher.check_needs_rehash(password_hash)
+
 def admin_required(f):
     """Decorator para verificar autenticação administrativa"""
     @wraps(f)
@@ -816,40 +2049,51 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# O dashboard não precisa de números ao segundo: as estatísticas ficam em
+# cache no processo por ADMIN_STATS_TTL segundos
+ADMIN_STATS_TTL = float(os.getenv('ADMIN_STATS_TTL', '60'))
+_admin_stats_cache = {'computed_at': None, 'stats': None}
+
 def get_admin_stats():
     """Calcula estatísticas para o dashboard administrativo"""
+    now = time.monotonic()
+    computed_at = _admin_stats_cache['computed_at']
+    if computed_at is not None and now - computed_at <= ADMIN_STATS_TTL:
+        return dict(_admin_stats_cache['stats'])
     try:
-        total_users = User.query.count()
-        total_uploads = User.query.filter(User.uploaded_file.isnot(None)).count()
+        # Contagens em uma única consulta (COUNT(coluna) ignora NULLs)
+        total_users, total_uploads = db.session.query(
+            func.count(User.id), func.count(User.uploaded_file)
+        ).one()
         
-        # Calcular receita total (usuários com pedidos configurados)
-        users_with_orders = User.query.filter(
-            User.order_configured == True,
-            User.total_cost.isnot(None)
-        ).all()
+        # Receita total (usuários com pedidos configurados), agregada no banco
+        order_filter = (User.order_configured == True, User.total_cost.isnot(None))
+        total_orders, total_revenue = db.session.query(
+            func.count(User.id), func.coalesce(func.sum(User.total_cost), 0)
+        ).filter(*order_filter).one()
+        average_order = total_revenue / total_orders if total_orders else 0
         
-        total_revenue = sum(user.total_cost for user in users_with_orders if user.total_cost)
-        average_order = total_revenue / len(users_with_orders) if users_with_orders else 0
+        # Papel mais usado: o banco ordena o histograma e devolve só o topo
+        # (empate resolvido pelo nome, como no max() sobre o GROUP BY)
+        paper_count = func.count(User.id)
+        most_used_paper = db.session.query(User.paper_type, paper_count).filter(
+            *order_filter, User.paper_type.isnot(None)
+        ).group_by(User.paper_type).order_by(paper_count.desc(), User.paper_type).first() or ('N/A', 0)
         
-        # Estatísticas de papel mais usado
-        paper_usage = {}
-        for user in users_with_orders:
-            if user.paper_type:
-                paper_usage[user.paper_type] = paper_usage.get(user.paper_type, 0) + 1
-        
-        most_used_paper = max(paper_usage.items(), key=lambda x: x[1]) if paper_usage else ('N/A', 0)
-        
-        return {
+        stats = {
             'total_users': total_users,
             'total_uploads': total_uploads,
-            'total_orders': len(users_with_orders),
+            'total_orders': total_orders,
             'total_revenue': round(total_revenue, 2),
             'average_order': round(average_order, 2),
             'most_used_paper': most_used_paper[0],
-            'conversion_rate': round((len(users_with_orders) / total_users * 100) if total_users > 0 else 0, 1)
+            'conversion_rate': round((total_orders / total_users * 100) if total_users > 0 else 0, 1)
         }
+        # Só resultados válidos entram no cache; em erro, a próxima visita tenta de novo
+        _admin_stats_cache.update(computed_at=now, stats=stats)
+        return dict(stats)
     except Exception as e:
-        print(f"Erro ao calcular estatísticas: {str(e)}")
+        logger.error(f"Erro ao calcular estatísticas: {e}")
         return {
             'total_users': 0, 'total_uploads': 0, 'total_orders': 0,
             'total_revenue': 0, 'average_order': 0, 'most_used_paper': 'N/A',
@@ -866,11 +2110,32 @@ def admin_login():
             flash('Usuário e senha são obrigatórios', 'error')
             return render_template('admin_login.html')
         
-        # Buscar admin pelo username
-        admin = Admin.query.filter_by(username=username, active=True).first()
+        # Buscar apenas o hash da senha do admin (consulta pré-montada, sem
+        # carregar a entidade inteira)
+        password_hash = db.session.execute(
+            _ADMIN_PASSWORD_HASH, {'username': username}
+        ).scalar_one_or_none()
         
-        # SEGURANÇA: Usar Werkzeug password hashing
-        if admin and check_password_hash(admin.password_hash, password):
+        # SEGURANÇA: Argon2id (comparação em tempo constante). Usuário
+        # inexistente também verifica contra um hash fictício, para o tempo de
+        # resposta não revelar quais usernames existem
+        if not _password_verify_slots.acquire(timeout=ADMIN_LOGIN_WAIT):
+            logger.warning("Login admin recusado: limite de verificações simultâneas atingido")
+            flash('Muitas tentativas de login no momento. Tente novamente em instantes.', 'error')
+            return render_template('admin_login.html'), 429
+        try:
+            password_ok, needs_rehash = verify_admin_password(
+                password_hash or _DUMMY_PASSWORD_HASH, password
+            )
+        finally:
+            _password_verify_slots.release()
+        if password_hash and password_ok:
+            if needs_rehash:
+                # Migração gradual: hash legado/parâmetros antigos -> Argon2id atual
+                Admin.query.filter_by(username=username).update(
+                    {'password_hash': hash_admin_password(password)}
+                )
+                db.session.commit()
             session['admin_logged_in'] = True
             session['admin_username'] = username
             session.permanent = True  # Usar tempo de sessão configurado
@@ -899,11 +2164,36 @@ def admin_dashboard():
 # CRUD ADMINISTRATIVO - TIPOS DE PAPEL
 # ============================================
 
+# Listagens do admin são paginadas como a de /users
+ADMIN_PER_PAGE = 50
+
+def _commit_unique(obj, duplicate_message):
+    """
+    Grava um novo item de preço do admin e invalida o cache de preços.
+    
+    Retorna False (com duplicate_message no flash) se o item já existir.
+    """
+    db.session.add(obj)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Nome (ou gramatura do papel) repetido: a restrição UNIQUE recusa o
+        # INSERT, sem uma consulta prévia (e sem a janela entre consultar e
+        # inserir)
+        db.session.rollback()
+        flash(duplicate_message, 'error')
+        return False
+    invalidate_price_cache()
+    return True
+
 @app.route('/admin/papers')
 @admin_required
 def admin_papers():
-    papers = PaperType.query.all()
-    return render_template('admin_papers.html', papers=papers)
+    # As gramaturas (contadas na listagem) vêm numa única consulta para a
+    # página inteira, não uma por papel
+    pagination = PaperType.query.options(selectinload(PaperType.weights)).order_by(PaperType.id).paginate(
+        page=request.args.get('page', 1, type=int), per_page=ADMIN_PER_PAGE, error_out=False)
+    return render_template('admin_papers.html', papers=pagination.items, pagination=pagination)
 
 @app.route('/admin/papers/create', methods=['GET', 'POST'])
 @admin_required
@@ -918,20 +2208,14 @@ def admin_papers_create():
                 flash('Nome e nome de exibição são obrigatórios', 'error')
                 return render_template('admin_paper_form.html')
             
-            # Verificar se já existe
-            existing = PaperType.query.filter_by(name=name).first()
-            if existing:
-                flash('Já existe um tipo de papel com esse nome', 'error')
-                return render_template('admin_paper_form.html')
-            
             # Criar novo tipo de papel
             paper_type = PaperType(
                 name=name,
                 display_name=display_name,
                 description=description
             )
-            db.session.add(paper_type)
-            db.session.commit()
+            if not _commit_unique(paper_type, 'Já existe um tipo de papel com esse nome'):
+                return render_template('admin_paper_form.html')
             
             flash('Tipo de papel criado com sucesso!', 'success')
             return redirect(url_for('admin_papers'))
@@ -946,8 +2230,9 @@ def admin_papers_create():
 @admin_required
 def admin_paper_weights(paper_id):
     paper = PaperType.query.get_or_404(paper_id)
-    weights = PaperWeight.query.filter_by(paper_type_id=paper_id).all()
-    return render_template('admin_paper_weights.html', paper=paper, weights=weights)
+    pagination = PaperWeight.query.filter_by(paper_type_id=paper_id).order_by(PaperWeight.id).paginate(
+        page=request.args.get('page', 1, type=int), per_page=ADMIN_PER_PAGE, error_out=False)
+    return render_template('admin_paper_weights.html', paper=paper, weights=pagination.items, pagination=pagination)
 
 @app.route('/admin/papers/<int:paper_id>/weights/create', methods=['GET', 'POST'])
 @admin_required
@@ -964,12 +2249,6 @@ def admin_paper_weights_create(paper_id):
                 flash('Todos os campos são obrigatórios', 'error')
                 return render_template('admin_weight_form.html', paper=paper)
             
-            # Verificar se já existe essa gramatura para este papel
-            existing = PaperWeight.query.filter_by(paper_type_id=paper_id, weight=weight).first()
-            if existing:
-                flash('Já existe essa gramatura para este tipo de papel', 'error')
-                return render_template('admin_weight_form.html', paper=paper)
-            
             # Criar nova gramatura
             paper_weight = PaperWeight(
                 paper_type_id=paper_id,
@@ -977,8 +2256,8 @@ def admin_paper_weights_create(paper_id):
                 price_color=price_color,
                 price_mono=price_mono
             )
-            db.session.add(paper_weight)
-            db.session.commit()
+            if not _commit_unique(paper_weight, 'Já existe essa gramatura para este tipo de papel'):
+                return render_template('admin_weight_form.html', paper=paper)
             
             flash('Gramatura adicionada com sucesso!', 'success')
             return redirect(url_for('admin_paper_weights', paper_id=paper_id))
@@ -996,8 +2275,9 @@ def admin_paper_weights_create(paper_id):
 @app.route('/admin/bindings')
 @admin_required
 def admin_bindings():
-    bindings = BindingType.query.all()
-    return render_template('admin_bindings.html', bindings=bindings)
+    pagination = BindingType.query.order_by(BindingType.id).paginate(
+        page=request.args.get('page', 1, type=int), per_page=ADMIN_PER_PAGE, error_out=False)
+    return render_template('admin_bindings.html', bindings=pagination.items, pagination=pagination)
 
 @app.route('/admin/bindings/create', methods=['GET', 'POST'])
 @admin_required
@@ -1013,12 +2293,6 @@ def admin_bindings_create():
                 flash('Nome, nome de exibição e preço são obrigatórios', 'error')
                 return render_template('admin_binding_form.html')
             
-            # Verificar se já existe
-            existing = BindingType.query.filter_by(name=name).first()
-            if existing:
-                flash('Já existe um tipo de encadernação com esse nome', 'error')
-                return render_template('admin_binding_form.html')
-            
             # Criar novo tipo de encadernação
             binding_type = BindingType(
                 name=name,
@@ -1026,8 +2300,8 @@ def admin_bindings_create():
                 description=description,
                 price=price
             )
-            db.session.add(binding_type)
-            db.session.commit()
+            if not _commit_unique(binding_type, 'Já existe um tipo de encadernação com esse nome'):
+                return render_template('admin_binding_form.html')
             
             flash('Tipo de encadernação criado com sucesso!', 'success')
             return redirect(url_for('admin_bindings'))
@@ -1045,8 +2319,9 @@ def admin_bindings_create():
 @app.route('/admin/finishings')
 @admin_required
 def admin_finishings():
-    finishings = FinishingType.query.all()
-    return render_template('admin_finishings.html', finishings=finishings)
+    pagination = FinishingType.query.order_by(FinishingType.id).paginate(
+        page=request.args.get('page', 1, type=int), per_page=ADMIN_PER_PAGE, error_out=False)
+    return render_template('admin_finishings.html', finishings=pagination.items, pagination=pagination)
 
 @app.route('/admin/finishings/create', methods=['GET', 'POST'])
 @admin_required
@@ -1062,12 +2337,6 @@ def admin_finishings_create():
                 flash('Nome, nome de exibição e preço são obrigatórios', 'error')
                 return render_template('admin_finishing_form.html')
             
-            # Verificar se já existe
-            existing = FinishingType.query.filter_by(name=name).first()
-            if existing:
-                flash('Já existe um tipo de acabamento com esse nome', 'error')
-                return render_template('admin_finishing_form.html')
-            
             # Criar novo tipo de acabamento
             finishing_type = FinishingType(
                 name=name,
@@ -1075,8 +2344,8 @@ def admin_finishings_create():
                 description=description,
                 price=price
             )
-            db.session.add(finishing_type)
-            db.session.commit()
+            if not _commit_unique(finishing_type, 'Já existe um tipo de acabamento com esse nome'):
+                return render_template('admin_finishing_form.html')
             
             flash('Tipo de acabamento criado com sucesso!', 'success')
             return redirect(url_for('admin_finishings'))
@@ -1093,11 +2362,70 @@ def admin_finishings_create():
 
 from datetime import datetime
 
+# API keys esperadas, lidas do ambiente uma única vez (o .env já foi carregado)
+EXPECTED_API_KEY = os.environ.get('API_KEY') or os.environ.get('WEB2PRINT_API_KEY')
+PDF_API_KEY = os.getenv('WEB2PRINT_API_KEY')
+
+def api_key_matches(api_key, expected_key):
+    """Compara a API key em tempo constante, sem vazar por timing o prefixo correto"""
+    return bool(api_key) and hmac.compare_digest(api_key.encode(), expected_key.encode())
+
+# Tentativas com API key inválida: cada IP tem um balde de
+# API_AUTH_FAILURE_LIMIT fichas por minuto, gasto só por falhas. Quem esgota
+# recebe 429 antes de qualquer outra validação; clientes com a key correta
+# nunca consomem fichas. 0 desliga o limite
+API_AUTH_FAILURE_LIMIT = int(os.getenv('API_AUTH_FAILURE_LIMIT', '100'))
+# Só atrás de um proxy confiável: usar o primeiro IP do X-Forwarded-For
+TRUST_X_FORWARDED_FOR = os.getenv('TRUST_X_FORWARDED_FOR', 'false').lower() == 'true'
+_AUTH_FAILURE_BUCKETS_SIZE = 4096
+_auth_failure_buckets = collections.OrderedDict()  # ip -> (fichas, monotonic)
+_auth_failure_lock = threading.Lock()
+
+def client_ip(request):
+    """IP de origem da requisição (X-Forwarded-For só se TRUST_X_FORWARDED_FOR)"""
+    if TRUST_X_FORWARDED_FOR:
+        forwarded = request.headers.get('X-Forwarded-For', '').split(',', 1)[0].strip()
+        if forwarded:
+            return forwarded
+    return request.remote_addr or ''
+
+def _auth_failure_tokens(ip, now):
+    """Fichas disponíveis para ip agora (reposição contínua); chamar com o lock"""
+    bucket = _auth_failure_buckets.get(ip)
+    if bucket is None:
+        return float(API_AUTH_FAILURE_LIMIT)
+    tokens, updated_at = bucket
+    return min(API_AUTH_FAILURE_LIMIT, tokens + (now - updated_at) * API_AUTH_FAILURE_LIMIT / 60)
+
+def auth_failures_exhausted(ip):
+    """True se ip já gastou todas as tentativas com API key inválida"""
+    if not API_AUTH_FAILURE_LIMIT:
+        return False
+    with _auth_failure_lock:
+        return _auth_failure_tokens(ip, time.monotonic()) < 1
+
+def record_auth_failure(ip):
+    """Consome uma ficha do balde de ip (mantendo no máximo 4096 IPs)"""
+    if not API_AUTH_FAILURE_LIMIT:
+        return
+    now = time.monotonic()
+    with _auth_failure_lock:
+        _auth_failure_buckets[ip] = (max(_auth_failure_tokens(ip, now) - 1, 0.0), now)
+        _auth_failure_buckets.move_to_end(ip)
+        while len(_auth_failure_buckets) > _AUTH_FAILURE_BUCKETS_SIZE:
+            _auth_failure_buckets.popitem(last=False)
+
+_TOO_MANY_AUTH_FAILURES = {
+    'success': False,
+    'error': 'Muitas tentativas com API key inválida - aguarde e tente novamente',
+    'error_code': 'RATE_LIMITED'
+}
+
 def validate_api_request(request):
     """Validar requisição API com key segura obrigatória"""
     # Verificar API key (obrigatória via environment)
     api_key = request.headers.get('X-API-Key')
-    expected_key = os.environ.get('API_KEY') or os.environ.get('WEB2PRINT_API_KEY')
+    expected_key = EXPECTED_API_KEY
     
     if not expected_key:
         return False, 'API não configurada corretamente - contate o administrador'
@@ -1105,47 +2433,200 @@ def validate_api_request(request):
     if not api_key:
         return False, 'Cabeçalho X-API-Key é obrigatório'
     
-    if api_key != expected_key:
+    if not api_key_matches(api_key, expected_key):
         return False, 'API key inválida'
     
     return True, None
 
+# Tempo (segundos) que o navegador pode reaproveitar a resposta do preflight
+# CORS antes de repetir o OPTIONS
+CORS_PREFLIGHT_MAX_AGE = os.getenv('CORS_PREFLIGHT_MAX_AGE', '86400')
+
+# Lista exata de origens permitidas para WooCommerce
+ALLOWED_CORS_ORIGINS = frozenset({
+    'http://localhost:3000',
+    'https://localhost:3000',
+    'http://localhost:8080',
+    'https://localhost:8080'
+})
+
+# Subdomínios HTTPS do WooCommerce/WordPress (.woocommerce.com,
+# .wordpress.com, .woocommerce.org e .wordpress.org)
+_WC_ORIGIN_RE = re.compile(r'^https://[^/]+\.(?:woocommerce|wordpress)\.(?:com|org)$')
+
 def get_cors_origin(request):
     """Determinar origem CORS permitida com validação rigorosa"""
     origin = request.headers.get('Origin', '')
     
-    # Lista exata de origens permitidas para WooCommerce
-    allowed_origins = [
-        'http://localhost:3000',
-        'https://localhost:3000',
-        'http://localhost:8080',
-        'https://localhost:8080'
-    ]
-    
-    # Permitir subdomínios específicos do WooCommerce/WordPress
-    allowed_domains = [
-        '.woocommerce.com',
-        '.wordpress.com',
-        '.woocommerce.org',
-        '.wordpress.org'
-    ]
-    
     if not origin:
         # Para testes locais sem Origin header
         return '*'
     
     # Verificar origem exata
-    if origin in allowed_origins:
+    if origin in ALLOWED_CORS_ORIGINS:
         return origin
     
-    # Verificar subdomínios permitidos
-    for domain in allowed_domains:
-        if origin.endswith(domain) and ('://' in origin):
-            # Validar que é HTTPS para domínios remotos
-            if origin.startswith('https://'):
-                return origin
+    # Verificar subdomínios permitidos (apenas HTTPS para domínios remotos)
+    return origin if _WC_ORIGIN_RE.match(origin) else None
+
+# Cabeçalhos CORS fixos de /api/v1/calculate_final, montados uma única vez
+_CALC_CORS_HEADERS = (
+    ('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-API-Key'),
+    ('Access-Control-Allow-Methods', 'POST,OPTIONS'),
+)
+_CALC_PREFLIGHT_HEADERS = _CALC_CORS_HEADERS + (
+    ('Access-Control-Max-Age', CORS_PREFLIGHT_MAX_AGE),
+)
+
+# Preflights dos endpoints abertos a qualquer origem (PDF por URL e status
+# de job): cabeçalhos fixos, montados uma única vez
+_PDF_URL_PREFLIGHT_HEADERS = MappingProxyType({
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-API-Key',
+    'Access-Control-Max-Age': CORS_PREFLIGHT_MAX_AGE,
+})
+_JOB_STATUS_PREFLIGHT_HEADERS = MappingProxyType({
+    **_PDF_URL_PREFLIGHT_HEADERS,
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+})
+
+def calc_cors_headers(cors_origin, preflight=False):
+    """Lista de cabeçalhos CORS de /api/v1/calculate_final para esta origem"""
+    headers = [('Access-Control-Allow-Origin', cors_origin)]
+    headers.extend(_CALC_PREFLIGHT_HEADERS if preflight else _CALC_CORS_HEADERS)
+    if cors_origin != '*':
+        headers.append(('Vary', 'Origin'))
+    return headers
+
+def calc_error_response(payload, status, cors_origin):
+    """
+    Resposta de erro de /api/v1/calculate_final: o Allow-Origin vai junto na
+    tupla de retorno, sem mutações de cabeçalho depois do jsonify.
+    
+    payload pode ser o dict do erro ou um corpo já serializado (bytes).
+    """
+    headers = (('Access-Control-Allow-Origin', cors_origin),) if cors_origin else ()
+    if isinstance(payload, bytes):
+        return app.response_class(payload, mimetype='application/json'), status, headers
+    return jsonify(payload), status, headers
+
+def _static_error_body(message, error_code):
+    """Corpo JSON de um erro de texto fixo, serializado uma vez na importação"""
+    return orjson.dumps({'success': False, 'error': message, 'error_code': error_code})
+
+# Valores aceitos por /api/v1/calculate_final. As tuplas guardam a ordem
+# usada nas mensagens de erro; os frozensets servem para a validação
+API_PAPER_WEIGHTS = frozenset({75, 90, 115, 120, 150})
+API_PAPER_TYPES = ('sulfite', 'couche', 'reciclado')
+API_BINDING_TYPES = ('grampo', 'spiral', 'wire-o', 'capa-dura')
+_API_PAPER_TYPES_SET = frozenset(API_PAPER_TYPES)
+_API_BINDING_TYPES_SET = frozenset(API_BINDING_TYPES)
+# Mensagens de rejeição já montadas
+_INVALID_PAPER_TYPE_MSG = f'Tipo de papel inválido. Valores permitidos: {", ".join(API_PAPER_TYPES)}'
+_INVALID_BINDING_TYPE_MSG = f'Tipo de encadernação inválido. Valores permitidos: {", ".join(API_BINDING_TYPES)}'
+
+# Nomes de exibição usados no breakdown da resposta
+BINDING_NAMES = {
+    'grampo': 'Grampo (2 grampos)',
+    'spiral': 'Espiral plástica',
+    'wire-o': 'Wire-o (espiral metálica)',
+    'capa-dura': 'Capa dura'
+}
+FINISHING_NAMES = {
+    'laminacao': 'Laminação',
+    'verniz': 'Verniz',
+    'dobra': 'Dobra',
+    'perfuracao': 'Perfuração'
+}
+API_FINISHINGS = frozenset(FINISHING_NAMES)
+# Separador da lista de acabamentos: vírgula, com os espaços em volta, num só
+# split. Espaço sozinho não separa ("laminacao verniz" continua inválido)
+_FINISHING_SPLIT = re.compile(r'\s*,\s*')
+
+# O JSON do orçamento tem poucas dezenas de bytes: corpos maiores são
+# recusados antes de qualquer leitura/parse
+CALC_MAX_JSON_BYTES = 16 * 1024
+
+# Erros de texto fixo do /api/v1/calculate_final, já em bytes
+_CALC_FORBIDDEN_ORIGIN_BODY = _static_error_body('Origem não permitida', 'FORBIDDEN_ORIGIN')
+_CALC_INVALID_CONTENT_TYPE_BODY = _static_error_body(
+    'Content-Type deve ser application/json', 'INVALID_CONTENT_TYPE')
+_CALC_PAYLOAD_TOO_LARGE_BODY = _static_error_body(
+    f'Corpo da requisição excede {CALC_MAX_JSON_BYTES} bytes', 'PAYLOAD_TOO_LARGE')
+_CALC_MISSING_JSON_BODY = _static_error_body(
+    'Corpo da requisição JSON é obrigatório', 'MISSING_JSON_BODY')
+
+def _calc_error(message, error_code, **extra):
+    return {'error': message, 'error_code': error_code, **extra}
+
+def parse_calculate_request(data):
+    """
+    Valida e normaliza o JSON do /api/v1/calculate_final.
     
-    return None
+    Returns:
+        tuple: (params, None) com os parâmetros prontos para
+        calculate_advanced_cost (mais finishing_info), ou (None, erro) com
+        'error'/'error_code' para a resposta 400
+    """
+    missing_fields = [field for field in ('color_pages', 'mono_pages') if field not in data]
+    if missing_fields:
+        return None, _calc_error(f'Campos obrigatórios ausentes: {", ".join(missing_fields)}',
+                                 'MISSING_REQUIRED_FIELDS', missing_fields=missing_fields)
+    
+    try:
+        color_pages = int(data.get('color_pages', 0))
+        mono_pages = int(data.get('mono_pages', 0))
+        paper_type = str(data.get('paper_type', 'sulfite')).strip().lower()
+        paper_weight = int(data.get('paper_weight', 90))
+        binding_type = str(data.get('binding_type', 'grampo')).strip().lower()
+        finishing = str(data.get('finishing', '')).strip().lower() if data.get('finishing') else ''
+        copy_quantity = int(data.get('copy_quantity', 1))
+    except (ValueError, TypeError):
+        return None, _calc_error('Tipos de dados inválidos. Verifique os valores numéricos.',
+                                 'INVALID_DATA_TYPES')
+    
+    total_pages = color_pages + mono_pages
+    # Pedido válido passa por uma única checagem de faixas; só quando ela
+    # falha os limites são conferidos um a um para escolher o erro
+    if not (color_pages >= 0 and mono_pages >= 0 and
+            0 < total_pages <= 500 and 0 < copy_quantity <= 1000):
+        if color_pages < 0 or mono_pages < 0:
+            return None, _calc_error('Número de páginas não pode ser negativo', 'INVALID_PAGE_COUNT')
+        if total_pages == 0:
+            return None, _calc_error('Total de páginas deve ser maior que zero', 'ZERO_PAGES')
+        if copy_quantity <= 0:
+            return None, _calc_error('Quantidade de cópias deve ser maior que zero', 'INVALID_QUANTITY')
+        if copy_quantity > 1000:
+            return None, _calc_error('Quantidade máxima de cópias é 1000', 'QUANTITY_EXCEEDED')
+        return None, _calc_error('Total de páginas excede o limite máximo de 500', 'PAGE_LIMIT_EXCEEDED')
+    if paper_type not in _API_PAPER_TYPES_SET:
+        return None, _calc_error(_INVALID_PAPER_TYPE_MSG, 'INVALID_PAPER_TYPE')
+    if binding_type not in _API_BINDING_TYPES_SET:
+        return None, _calc_error(_INVALID_BINDING_TYPE_MSG, 'INVALID_BINDING_TYPE')
+    
+    # Gramatura fora da lista cai no default seguro
+    if paper_weight not in API_PAPER_WEIGHTS:
+        paper_weight = 90
+    
+    # Limpar acabamentos numa única passada; a mesma lista fornece os nomes
+    # de exibição do breakdown
+    finishing_info = ''
+    if finishing:
+        finishing_list = [f for f in _FINISHING_SPLIT.split(finishing.strip()) if f in API_FINISHINGS]
+        finishing = ','.join(finishing_list) or None
+        finishing_info = ', '.join([FINISHING_NAMES[f] for f in finishing_list])
+    
+    return {
+        'color_pages': color_pages,
+        'mono_pages': mono_pages,
+        'paper_type': paper_type,
+        'paper_weight': paper_weight,
+        'binding_type': binding_type,
+        'finishing': finishing,
+        'copy_quantity': copy_quantity,
+        'finishing_info': finishing_info
+    }, None
 
 @app.route('/api/v1/calculate_final', methods=['POST', 'OPTIONS'])
 @csrf.exempt
@@ -1187,179 +2668,78 @@ def api_calculate_final():
     }
     """
     
+    # Origem CORS resolvida uma única vez e reaproveitada por todas as
+    # respostas abaixo (preflight, erros de validação, sucesso e exceção)
+    cors_origin = get_cors_origin(request)
+    
     # Handle CORS preflight requests
+    # (o navegador só lê status e cabeçalhos do preflight: respostas sem corpo)
     if request.method == 'OPTIONS':
-        cors_origin = get_cors_origin(request)
         if not cors_origin:
-            return jsonify({'error': 'Origem não permitida'}), 403
-            
-        response = jsonify({'status': 'ok'})
-        response.headers.add('Access-Control-Allow-Origin', cors_origin)
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-API-Key')
-        response.headers.add('Access-Control-Allow-Methods', 'POST,OPTIONS')
-        if cors_origin != '*':
-            response.headers.add('Vary', 'Origin')
-        return response
+            return '', 403
+        return '', 204, calc_cors_headers(cors_origin, preflight=True)
     
     try:
+        ip = client_ip(request)
+        if auth_failures_exhausted(ip):
+            return calc_error_response(_TOO_MANY_AUTH_FAILURES, 429, cors_origin)
+        
         # Validar API key e origem
         is_valid, error_msg = validate_api_request(request)
-        cors_origin = get_cors_origin(request)
         
         if not is_valid:
-            response = jsonify({
+            record_auth_failure(ip)
+            return calc_error_response({
                 'success': False,
                 'error': error_msg,
                 'error_code': 'UNAUTHORIZED'
-            })
-            if cors_origin:
-                response.headers.add('Access-Control-Allow-Origin', cors_origin)
-            return response, 401
+            }, 401, cors_origin)
         
         if not cors_origin:
-            return jsonify({
-                'success': False,
-                'error': 'Origem não permitida',
-                'error_code': 'FORBIDDEN_ORIGIN'
-            }), 403
+            return calc_error_response(_CALC_FORBIDDEN_ORIGIN_BODY, 403, None)
         
-        # Log da requisição para debugging (sem dados sensíveis)
-        print(f"[API] WooCommerce request at {datetime.now()}")
-        print(f"[API] Content-Type: {request.content_type}")
-        print(f"[API] Method: {request.method}")
-        print(f"[API] Origin: {request.headers.get('Origin', 'N/A')}")
+        # Log da requisição para debugging (sem dados sensíveis). Formatação
+        # com argumentos: a mensagem só é montada quando o nível DEBUG está ativo
+        logger.debug("[API] WooCommerce request: Content-Type=%s, Method=%s, Origin=%s",
+                     request.content_type, request.method, request.headers.get('Origin', 'N/A'))
         
         # Verificar Content-Type
         if not request.is_json:
-            response = jsonify({
-                'success': False,
-                'error': 'Content-Type deve ser application/json',
-                'error_code': 'INVALID_CONTENT_TYPE'
-            })
-            response.headers.add('Access-Control-Allow-Origin', cors_origin or '*')
-            return response, 400
+            return calc_error_response(_CALC_INVALID_CONTENT_TYPE_BODY, 400, cors_origin)
         
-        # Obter dados JSON
-        data = request.get_json()
-        
-        if not data:
-            response = jsonify({
-                'success': False,
-                'error': 'Corpo da requisição JSON é obrigatório',
-                'error_code': 'MISSING_JSON_BODY'
-            })
-            response.headers.add('Access-Control-Allow-Origin', cors_origin or '*')
-            return response, 400
-        
-        # Validação de campos obrigatórios
-        required_fields = ['color_pages', 'mono_pages']
-        missing_fields = [field for field in required_fields if field not in data]
-        
-        if missing_fields:
-            response = jsonify({
-                'success': False,
-                'error': f'Campos obrigatórios ausentes: {", ".join(missing_fields)}',
-                'error_code': 'MISSING_REQUIRED_FIELDS',
-                'missing_fields': missing_fields
-            })
-            response.headers.add('Access-Control-Allow-Origin', cors_origin or '*')
-            return response, 400
+        if (request.content_length or 0) > CALC_MAX_JSON_BYTES:
+            return calc_error_response(_CALC_PAYLOAD_TOO_LARGE_BODY, 413, cors_origin)
         
-        # Extrair e validar parâmetros
+        # Obter dados JSON (corpo sem Content-Length também fica limitado;
+        # JSON malformado cai no erro de corpo ausente abaixo). Num corpo
+        # chunked o stream limitado apenas trunca a leitura: com um byte de
+        # folga no limite, ler além de CALC_MAX_JSON_BYTES denuncia o excesso
+        request.max_content_length = CALC_MAX_JSON_BYTES + 1
         try:
-            color_pages = int(data.get('color_pages', 0))
-            mono_pages = int(data.get('mono_pages', 0))
-            paper_type = str(data.get('paper_type', 'sulfite')).strip().lower()
-            paper_weight = int(data.get('paper_weight', 90))
-            binding_type = str(data.get('binding_type', 'grampo')).strip().lower()
-            finishing = str(data.get('finishing', '')).strip().lower() if data.get('finishing') else ''
-            copy_quantity = int(data.get('copy_quantity', 1))
-            
-        except (ValueError, TypeError):
-            response = jsonify({
-                'success': False,
-                'error': 'Tipos de dados inválidos. Verifique os valores numéricos.',
-                'error_code': 'INVALID_DATA_TYPES'
-            })
-            response.headers.add('Access-Control-Allow-Origin', cors_origin or '*')
-            return response, 400
-        
-        # Validação de valores
-        if color_pages < 0 or mono_pages < 0:
-            return jsonify({
-                'success': False,
-                'error': 'Número de páginas não pode ser negativo',
-                'error_code': 'INVALID_PAGE_COUNT'
-            }), 400
-        
-        if color_pages + mono_pages == 0:
-            return jsonify({
-                'success': False,
-                'error': 'Total de páginas deve ser maior que zero',
-                'error_code': 'ZERO_PAGES'
-            }), 400
-        
-        if copy_quantity <= 0:
-            return jsonify({
-                'success': False,
-                'error': 'Quantidade de cópias deve ser maior que zero',
-                'error_code': 'INVALID_QUANTITY'
-            }), 400
+            body_too_large = len(request.get_data(cache=True)) > CALC_MAX_JSON_BYTES
+        except RequestEntityTooLarge:
+            body_too_large = True
+        if body_too_large:
+            return calc_error_response(_CALC_PAYLOAD_TOO_LARGE_BODY, 413, cors_origin)
+        data = request.get_json(silent=True)
         
-        if copy_quantity > 1000:
-            return jsonify({
-                'success': False,
-                'error': 'Quantidade máxima de cópias é 1000',
-                'error_code': 'QUANTITY_EXCEEDED'
-            }), 400
+        if not data:
+            return calc_error_response(_CALC_MISSING_JSON_BODY, 400, cors_origin)
         
-        # Validar limites superiores rigorosos
-        if color_pages + mono_pages > 500:
-            response = jsonify({
-                'success': False,
-                'error': 'Total de páginas excede o limite máximo de 500',
-                'error_code': 'PAGE_LIMIT_EXCEEDED'
-            })
-            response.headers.add('Access-Control-Allow-Origin', cors_origin or '*')
-            return response, 400
-        
-        # Validar peso do papel nos valores permitidos
-        valid_weights = [75, 90, 115, 120, 150]
-        if paper_weight not in valid_weights:
-            paper_weight = 90  # Default seguro
-        
-        # Validar tipos de papel rigorosamente
-        valid_paper_types = ['sulfite', 'couche', 'reciclado']
-        if paper_type not in valid_paper_types:
-            response = jsonify({
-                'success': False,
-                'error': f'Tipo de papel inválido. Valores permitidos: {", ".join(valid_paper_types)}',
-                'error_code': 'INVALID_PAPER_TYPE'
-            })
-            response.headers.add('Access-Control-Allow-Origin', cors_origin or '*')
-            return response, 400
+        # Validação completa numa única passada; qualquer erro sai pelo
+        # mesmo caminho de resposta (com CORS)
+        params, error = parse_calculate_request(data)
+        if error:
+            return calc_error_response({'success': False, **error}, 400, cors_origin)
         
-        # Validar tipos de encadernação rigorosamente
-        valid_binding_types = ['grampo', 'spiral', 'wire-o', 'capa-dura']
-        if binding_type not in valid_binding_types:
-            response = jsonify({
-                'success': False,
-                'error': f'Tipo de encadernação inválido. Valores permitidos: {", ".join(valid_binding_types)}',
-                'error_code': 'INVALID_BINDING_TYPE'
-            })
-            response.headers.add('Access-Control-Allow-Origin', cors_origin or '*')
-            return response, 400
-        
-        # Limpar e validar acabamentos
-        if finishing:
-            finishing = finishing.strip()
-            if finishing:
-                valid_finishings = ['laminacao', 'verniz', 'dobra', 'perfuracao']
-                finishing_list = [f.strip() for f in finishing.split(',')]
-                finishing_list = [f for f in finishing_list if f in valid_finishings]
-                finishing = ','.join(finishing_list) if finishing_list else None
-            else:
-                finishing = None
+        color_pages = params['color_pages']
+        mono_pages = params['mono_pages']
+        paper_type = params['paper_type']
+        paper_weight = params['paper_weight']
+        binding_type = params['binding_type']
+        finishing = params['finishing']
+        copy_quantity = params['copy_quantity']
+        finishing_info = params['finishing_info']
         
         # Calcular custo usando função existente
         cost_details = calculate_advanced_cost(
@@ -1375,25 +2755,7 @@ def api_calculate_final():
         # Preparar informações descritivas
         paper_info = f"{paper_type.title()} {paper_weight}g"
         
-        binding_names = {
-            'grampo': 'Grampo (2 grampos)',
-            'spiral': 'Espiral plástica',
-            'wire-o': 'Wire-o (espiral metálica)',
-            'capa-dura': 'Capa dura'
-        }
-        binding_info = binding_names.get(binding_type, binding_type.title())
-        
-        finishing_info = ''
-        if finishing:
-            finishing_names = {
-                'laminacao': 'Laminação',
-                'verniz': 'Verniz',
-                'dobra': 'Dobra',
-                'perfuracao': 'Perfuração'
-            }
-            finishing_list = [finishing_names.get(f.strip(), f.strip().title()) 
-                            for f in finishing.split(',')]
-            finishing_info = ', '.join(finishing_list)
+        binding_info = BINDING_NAMES.get(binding_type, binding_type.title())
         
         # Resposta estruturada para WooCommerce
         response_data = {
@@ -1414,65 +2776,71 @@ def api_calculate_final():
                 'finishing': finishing,
                 'copy_quantity': copy_quantity
             },
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now_iso()
         }
         
         # Log da resposta para debugging
-        print(f"[API] Successful calculation: R$ {cost_details['total_cost']}")
+        logger.debug("[API] Successful calculation: R$ %.2f", cost_details['total_cost'])
         
         # Configurar resposta com CORS
         response = jsonify(response_data)
-        response.headers.add('Access-Control-Allow-Origin', cors_origin)
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-API-Key')
-        response.headers.add('Access-Control-Allow-Methods', 'POST,OPTIONS')
-        response.headers.add('Content-Type', 'application/json; charset=utf-8')
-        if cors_origin != '*':
-            response.headers.add('Vary', 'Origin')
+        response.headers.extend(calc_cors_headers(cors_origin))
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
         
         return response
         
     except Exception as e:
         # Log detalhado do erro
-        print(f"[API] Error in calculate_final: {str(e)}")
-        print(f"[API] Error type: {type(e).__name__}")
+        logger.error(f"[API] Error in calculate_final: {type(e).__name__}: {e}")
         
         # Configurar resposta de erro com CORS
-        cors_origin = get_cors_origin(request) or '*'
         response = jsonify({
             'success': False,
             'error': 'Erro interno do servidor ao calcular custos',
             'error_code': 'INTERNAL_ERROR',
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now_iso()
         })
-        response.headers.add('Access-Control-Allow-Origin', cors_origin)
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-API-Key')
-        response.headers.add('Access-Control-Allow-Methods', 'POST,OPTIONS')
-        if cors_origin != '*':
-            response.headers.add('Vary', 'Origin')
+        response.headers.extend(calc_cors_headers(cors_origin or '*'))
         return response, 500
 
+# Resultado do último teste de banco do /health: probes do load balancer a
+# cada poucos segundos reaproveitam o resultado em vez de consultar o banco
+_health_cache = {'checked_at': None, 'error': None}
+
+def check_database_health():
+    """SELECT 1 no máximo uma vez a cada HEALTH_DB_CHECK_TTL segundos; retorna o erro ou None"""
+    now = time.monotonic()
+    checked_at = _health_cache['checked_at']
+    if checked_at is None or now - checked_at > HEALTH_DB_CHECK_TTL:
+        # Conexão própria, devolvida ao pool logo após o SELECT (a da sessão
+        # só seria liberada no fim do request)
+        try:
+            with db.engine.connect() as conn:
+                conn.exec_driver_sql('SELECT 1')
+            error = None
+        except Exception as e:
+            error = str(e)
+        _health_cache.update(checked_at=now, error=error)
+    return _health_cache['error']
+
 @app.route('/api/v1/health', methods=['GET'])
 def api_health():
     """Endpoint de verificação de saúde da API"""
-    try:
-        # Verificar conexão com banco de dados
-        from sqlalchemy import text
-        db.session.execute(text('SELECT 1'))
-        
+    error = check_database_health()
+    if error is None:
         return jsonify({
             'status': 'healthy',
             'service': 'web2print-api',
             'version': '1.0',
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': now_iso(),
             'database': 'connected'
         })
-    except Exception as e:
-        return jsonify({
-            'status': 'unhealthy',
-            'service': 'web2print-api',
-            'error': str(e),
-            'timestamp': datetime.now().isoformat()
-        }), 500
+    return jsonify({
+        'status': 'unhealthy',
+        'service': 'web2print-api',
+        'error': error,
+        'timestamp': now_iso()
+    }), 500
 
 @app.route('/api/v1/analyze_pdf_url', methods=['POST', 'OPTIONS'])
 @csrf.exempt
@@ -1489,16 +2857,16 @@ def api_analyze_pdf_url():
     """
     # CORS headers para WordPress
     if request.method == 'OPTIONS':
-        return '', 200, {
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'POST, OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type, X-API-Key',
-        }
+        return '', 204, _PDF_URL_PREFLIGHT_HEADERS
     
     try:
+        ip = client_ip(request)
+        if auth_failures_exhausted(ip):
+            return jsonify(_TOO_MANY_AUTH_FAILURES), 429
+        
         # CRÍTICO: Verificar autenticação via API Key
         api_key = request.headers.get('X-API-Key') 
-        expected_key = os.getenv('WEB2PRINT_API_KEY')
+        expected_key = PDF_API_KEY
         
         # SEGURANÇA: Não permitir chave padrão em produção
         if not expected_key:
@@ -1510,7 +2878,8 @@ def api_analyze_pdf_url():
                 }), 500
             expected_key = 'web2print-dev-key-only'
         
-        if not api_key or api_key != expected_key:
+        if not api_key_matches(api_key, expected_key):
+            record_auth_failure(ip)
             return jsonify({
                 'success': False,
                 'error': 'API Key inválida ou ausente',
@@ -1530,7 +2899,6 @@ def api_analyze_pdf_url():
         
         # SEGURANÇA: Validação robusta de URL para prevenir SSRF
         from urllib.parse import urlparse
-        import ipaddress
         
         parsed = urlparse(pdf_url)
         if parsed.scheme not in ('http', 'https'):
@@ -1540,43 +2908,42 @@ def api_analyze_pdf_url():
                 'error_code': 'INVALID_URL_SCHEME'
             }), 400
         
+        # Validação adicional: deve ter extensão .pdf (antes da consulta DNS;
+        # só os 4 últimos caracteres são copiados para a comparação)
+        if pdf_url[-4:].lower() != '.pdf':
+            return jsonify({
+                'success': False,
+                'error': 'URL deve apontar para arquivo .pdf',
+                'error_code': 'INVALID_FILE_TYPE'
+            }), 400
+        
         # SEGURANÇA ROBUSTA: Verificar TODAS as IPs (IPv4 e IPv6) 
         try:
-            import socket
             hostname = parsed.hostname or ''
             
-            # Resolver todos os IPs (A e AAAA records)
+            # Resolver todos os IPs (A e AAAA records), com cache por host
             try:
-                addr_info = socket.getaddrinfo(hostname, None)
+                validated_ips = resolve_download_host(hostname)
             except socket.gaierror:
                 return jsonify({
                     'success': False,
                     'error': 'Não foi possível resolver hostname',
                     'error_code': 'DNS_RESOLUTION_FAILED'
                 }), 400
-            
-            for family, type, proto, canonname, sockaddr in addr_info:
-                ip = sockaddr[0]  # IP está sempre no primeiro elemento
-                try:
-                    ip_obj = ipaddress.ip_address(ip)
-                    
-                    # Bloquear IPs privados/locais/reservados (IPv4 e IPv6)
-                    if (ip_obj.is_private or ip_obj.is_loopback or 
-                        ip_obj.is_link_local or ip_obj.is_reserved or
-                        ip_obj.is_multicast):
-                        return jsonify({
-                            'success': False,
-                            'error': f'IP {ip} é interno/privado - bloqueado por segurança',
-                            'error_code': 'SSRF_BLOCKED'
-                        }), 403
-                        
-                except ValueError:
-                    # IP inválido
-                    return jsonify({
-                        'success': False,
-                        'error': f'IP inválido detectado: {ip}',
-                        'error_code': 'INVALID_IP'
-                    }), 400
+            except BlockedAddressError as blocked:
+                # Bloquear IPs privados/locais/reservados (IPv4 e IPv6)
+                return jsonify({
+                    'success': False,
+                    'error': str(blocked),
+                    'error_code': 'SSRF_BLOCKED'
+                }), 403
+            except ValueError as invalid_ip:
+                # IP inválido
+                return jsonify({
+                    'success': False,
+                    'error': f'IP inválido detectado: {invalid_ip}',
+                    'error_code': 'INVALID_IP'
+                }), 400
                     
         except Exception as e:
             return jsonify({
@@ -1585,14 +2952,6 @@ def api_analyze_pdf_url():
                 'error_code': 'SECURITY_CHECK_FAILED'
             }), 400
         
-        # Validação adicional: deve ter extensão .pdf
-        if not pdf_url.lower().endswith('.pdf'):
-            return jsonify({
-                'success': False,
-                'error': 'URL deve apontar para arquivo .pdf',
-                'error_code': 'INVALID_FILE_TYPE'
-            }), 400
-        
         # Baixar PDF temporariamente via requests
         try:
             logger.info(f"Iniciando download seguro de PDF: {pdf_url}")
@@ -1603,16 +2962,19 @@ def api_analyze_pdf_url():
             read_timeout = PDF_DOWNLOAD_TIMEOUT  # Leitura baseada na configuração
             
             # SEGURANÇA: Bloquear redirects para prevenir SSRF via redirect  
-            response = requests.get(
-                pdf_url, 
-                timeout=(connect_timeout, read_timeout), 
-                stream=True, 
-                allow_redirects=False,
-                headers={'User-Agent': 'Web2Print-Downloader/1.0'}
-            )
+            # A conexão usa os IPs já validados acima, sem uma segunda consulta DNS
+            with pinned_download_addresses(hostname, validated_ips):
+                response = PDF_DOWNLOAD_SESSION.get(
+                    pdf_url, 
+                    timeout=(connect_timeout, read_timeout), 
+                    stream=True, 
+                    allow_redirects=False,
+                    headers={'User-Agent': 'Web2Print-Downloader/1.0'}
+                )
             
             # Verificar se é redirect
             if response.status_code in (301, 302, 303, 307, 308):
+                response.close()
                 return jsonify({
                     'success': False,
                     'error': 'Redirects não são permitidos por segurança',
@@ -1625,6 +2987,7 @@ def api_analyze_pdf_url():
             max_size = 50 * 1024 * 1024  # 50MB máximo
             content_length = response.headers.get('content-length')
             if content_length and int(content_length) > max_size:
+                response.close()
                 return jsonify({
                     'success': False,
                     'error': 'Arquivo muito grande. Máximo 50MB.',
@@ -1634,6 +2997,7 @@ def api_analyze_pdf_url():
             # CRÍTICO: Verificar Content-Type rigorosamente
             content_type = response.headers.get('content-type', '')
             if not content_type.startswith('application/pdf'):
+                response.close()
                 return jsonify({
                     'success': False,
                     'error': f'Content-Type inválido: {content_type}. Apenas application/pdf é aceito.',
@@ -1649,11 +3013,12 @@ def api_analyze_pdf_url():
             }), 422
         
         # FASE 1: VERIFICAÇÃO OTIMIZADA DE TAMANHO
-        operation_start = time.time()
+        operation_start = time.monotonic()
         
-        # Verificar tamanho antes do download (otimização)
-        size_check = check_pdf_size_before_download(pdf_url, MAX_PDF_SIZE_TOTAL)
+        # Verificar tamanho antes de ler o corpo, pelos cabeçalhos do GET já aberto
+        size_check = check_pdf_size_before_download(response, MAX_PDF_SIZE_TOTAL)
         if not size_check['allowed']:
+            response.close()
             logger.warning(f"Download bloqueado por tamanho: {size_check['message']}")
             return jsonify({
                 'success': False,
@@ -1667,6 +3032,8 @@ def api_analyze_pdf_url():
         # Se arquivo grande (>10MB) ou tamanho desconhecido (potencialmente grande), usar processamento assíncrono
         if file_size > MAX_PDF_SIZE_SYNC or file_size == 0:
             logger.info(f"Arquivo grande ou tamanho desconhecido ({file_size:,} bytes) - criando job assíncrono")
+            # O worker baixa o arquivo por conta própria: devolver a conexão ao pool
+            response.close()
             
             # Criar job assíncrono
             job_id = str(uuid.uuid4())
@@ -1681,12 +3048,13 @@ def api_analyze_pdf_url():
                 job_type='pdf_analysis_url',
                 status='pending',
                 progress=0,
-                input_data=json.dumps(input_data),
                 expires_at=datetime.now() + timedelta(hours=2)  # Expira em 2 horas
             )
+            job.set_input(input_data)
             
             db.session.add(job)
             db.session.commit()
+            notify_job_worker()
             
             logger.info(f"Job criado: {job_id} para PDF: {pdf_url}")
             
@@ -1704,138 +3072,142 @@ def api_analyze_pdf_url():
             logger.info(f"Arquivo pequeno ({file_size:,} bytes) - processamento síncrono")
         
         # PROCESSAMENTO SÍNCRONO PARA ARQUIVOS PEQUENOS
-        with secure_temp_pdf_file() as temp_path:
-            # DOWNLOAD SEGURO COM LIMITE RÍGIDO DE BYTES
-            downloaded = 0
-            chunk_count = 0
-            download_start = time.time()
-            
-            # Obter Content-Length se disponível para melhor logging
-            expected_size = response.headers.get('content-length')
-            if expected_size:
-                expected_size = int(expected_size)
-                logger.info(f"Tamanho esperado: {expected_size:,} bytes ({expected_size/1024/1024:.1f}MB)")
-            else:
-                logger.warning("Content-Length não disponível - aplicando limite cumulativo rígido")
-                expected_size = None
-            
-            with open(temp_path, 'wb') as temp_file:
-                try:
-                    for chunk in response.iter_content(chunk_size=64*1024):  # 64KB chunks
-                        if chunk:
-                            chunk_count += 1
-                            downloaded += len(chunk)
-                            
-                            # LIMITE RÍGIDO: Parar imediatamente se exceder limite
-                            if downloaded > MAX_PDF_SIZE_TOTAL:
-                                elapsed = time.time() - download_start
-                                logger.error(
-                                    f"Download abortado por exceder limite: {downloaded:,} bytes "
-                                    f"(máx: {MAX_PDF_SIZE_TOTAL:,}) em {elapsed:.2f}s, {chunk_count} chunks"
-                                )
-                                return jsonify({
-                                    'success': False,
-                                    'error': f'Arquivo muito grande para download: {downloaded/1024/1024:.1f}MB (máximo permitido: {MAX_PDF_SIZE_TOTAL/1024/1024:.1f}MB)',
-                                    'error_code': 'PAYLOAD_TOO_LARGE',
-                                    'downloaded_bytes': downloaded,
-                                    'max_bytes': MAX_PDF_SIZE_TOTAL
-                                }), 413  # Payload Too Large
-                            
-                            temp_file.write(chunk)
-                            
-                            # Log de progresso para arquivos grandes (a cada 10MB)
-                            if downloaded % (10 * 1024 * 1024) == 0 or (downloaded > 0 and chunk_count % 100 == 0):
-                                elapsed = time.time() - download_start
-                                speed_mbps = (downloaded / (1024 * 1024)) / max(elapsed, 0.1)
-                                logger.debug(f"Download em progresso: {downloaded/1024/1024:.1f}MB ({speed_mbps:.1f}MB/s)")
-                                
-                except requests.exceptions.RequestException as download_error:
-                    elapsed = time.time() - download_start
-                    logger.error(
-                        f"Erro durante download: {download_error} - "
-                        f"Baixados: {downloaded:,} bytes em {elapsed:.2f}s"
-                    )
-                    return jsonify({
-                        'success': False,
-                        'error': 'Falha durante download do arquivo PDF',
-                        'error_code': 'DOWNLOAD_FAILED',
-                        'details': str(download_error)
-                    }), 422  # Unprocessable Entity
-            
-            download_duration = time.time() - download_start
-            logger.info(f"Download concluído: {downloaded:,} bytes em {download_duration:.2f}s")
-            
-            # ANÁLISE COM LOGGING DETALHADO
-            analysis_start = time.time()
-            
-            try:
-                # Verificar se PyMuPDF está disponível
-                try:
-                    import fitz
-                except ImportError as fitz_error:
-                    logger.warning(f"PyMuPDF não encontrado: {fitz_error}")
-                    raise ImportError("PyMuPDF não disponível") from fitz_error
+        # DOWNLOAD SEGURO COM LIMITE RÍGIDO DE BYTES
+        downloaded = 0
+        chunk_count = 0
+        download_start = time.monotonic()
+        
+        # Obter Content-Length se disponível para melhor logging
+        expected_size = response.headers.get('content-length')
+        if expected_size:
+            expected_size = int(expected_size)
+            logger.info(f"Tamanho esperado: {expected_size:,} bytes ({expected_size/1024/1024:.1f}MB)")
+        else:
+            logger.warning("Content-Length não disponível - aplicando limite cumulativo rígido")
+            expected_size = None
+        
+        # Hash calculado durante o download. O PDF pequeno fica em memória
+        # (o limite rígido abaixo vale igual): o PyMuPDF abre os próprios
+        # bytes, sem gravar e reler um arquivo temporário
+        digest = _new_file_digest()
+        pdf_buffer = bytearray()
+        try:
+            for chunk in response.iter_content(chunk_size=PDF_DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    chunk_count += 1
+                    downloaded += len(chunk)
                     
-                color_stats = analyze_pdf_colors(temp_path)
-                analysis_method = 'PyMuPDF_precise'
-                logger.info(f"Análise PyMuPDF concluída: {color_stats}")
-                
-            except ImportError:
-                # Fallback para análise básica se PyMuPDF não disponível
-                logger.warning("PyMuPDF não disponível, usando fallback PyPDF2")
-                with open(temp_path, 'rb') as pdf_file:
-                    pdf_reader = PyPDF2.PdfReader(pdf_file)
-                    total_pages = len(pdf_reader.pages)
-                    # Estimativa conservadora: 30% colorido
-                    color_pages = max(1, int(total_pages * 0.3))
-                    mono_pages = total_pages - color_pages
+                    # LIMITE RÍGIDO: Parar imediatamente se exceder limite
+                    if downloaded > MAX_PDF_SIZE_TOTAL:
+                        elapsed = time.monotonic() - download_start
+                        logger.error(
+                            f"Download abortado por exceder limite: {downloaded:,} bytes "
+                            f"(máx: {MAX_PDF_SIZE_TOTAL:,}) em {elapsed:.2f}s, {chunk_count} chunks"
+                        )
+                        response.close()
+                        return jsonify({
+                            'success': False,
+                            'error': f'Arquivo muito grande para download: {downloaded/1024/1024:.1f}MB (máximo permitido: {MAX_PDF_SIZE_TOTAL_MB})',
+                            'error_code': 'PAYLOAD_TOO_LARGE',
+                            'downloaded_bytes': downloaded,
+                            'max_bytes': MAX_PDF_SIZE_TOTAL
+                        }), 413  # Payload Too Large
                     
-                color_stats = {
-                    'total_pages': total_pages,
-                    'color_pages': color_pages,
-                    'mono_pages': mono_pages,
-                    'color_type': 'mixed' if color_pages > 0 else 'mono'
-                }
-                analysis_method = 'PyPDF2_estimate'
-            
-            analysis_duration = time.time() - analysis_start
-            total_duration = time.time() - operation_start
-            
-            # Log de performance estruturado
-            log_api_performance(
-                operation='pdf_analysis_url',
-                duration=total_duration,
-                file_size=downloaded,
-                success=True
-            )
-            
-            logger.info(
-                f"Análise completa - Método: {analysis_method}, "
-                f"Arquivo: {downloaded/1024:.1f}KB, "
-                f"Download: {download_duration:.2f}s, "
-                f"Análise: {analysis_duration:.2f}s, "
-                f"Total: {total_duration:.2f}s"
+                    pdf_buffer += chunk
+                    digest.update(chunk)
+                    
+                    # Log de progresso para arquivos grandes (a cada 10MB)
+                    if chunk_count % 10 == 0:
+                        elapsed = time.monotonic() - download_start
+                        speed_mbps = (downloaded / (1024 * 1024)) / max(elapsed, 0.1)
+                        logger.debug(f"Download em progresso: {downloaded/1024/1024:.1f}MB ({speed_mbps:.1f}MB/s)")
+                        
+        except requests.exceptions.RequestException as download_error:
+            elapsed = time.monotonic() - download_start
+            logger.error(
+                f"Erro durante download: {download_error} - "
+                f"Baixados: {downloaded:,} bytes em {elapsed:.2f}s"
             )
-            
-            # Retornar dados de análise com metadados de performance
             return jsonify({
-                'success': True,
-                'data': {
-                    'total_pages': color_stats['total_pages'],
-                    'color_pages': color_stats['color_pages'], 
-                    'mono_pages': color_stats['mono_pages'],
-                    'color_type': color_stats['color_type'],
-                    'analysis_method': analysis_method,
-                    'file_size_bytes': downloaded,
-                    'processing_time_seconds': round(total_duration, 2)
-                },
-                'message': f'PDF analisado com sucesso via {analysis_method} em {total_duration:.1f}s'
-            }), 200
+                'success': False,
+                'error': 'Falha durante download do arquivo PDF',
+                'error_code': 'DOWNLOAD_FAILED',
+                'details': str(download_error)
+            }), 422  # Unprocessable Entity
+    
+        download_duration = time.monotonic() - download_start
+        logger.info(f"Download concluído: {downloaded:,} bytes em {download_duration:.2f}s")
+        pdf_data = bytes(pdf_buffer)
+        del pdf_buffer
+        
+        # ANÁLISE COM LOGGING DETALHADO
+        analysis_start = time.monotonic()
+        
+        try:
+            # Verificar se PyMuPDF está disponível
+            try:
+                _get_fitz()
+            except ImportError as fitz_error:
+                logger.warning(f"PyMuPDF não encontrado: {fitz_error}")
+                raise ImportError("PyMuPDF não disponível") from fitz_error
+                
+            color_stats = analyze_pdf_colors_cached(pdf_data, digest.hexdigest())
+            analysis_method = 'PyMuPDF_precise'
+            logger.info(f"Análise PyMuPDF concluída: {color_stats}")
+            
+        except ImportError:
+            # Fallback para análise básica se PyMuPDF não disponível
+            logger.warning("PyMuPDF não disponível, usando fallback pypdf")
+            pdf_reader = _get_pypdf().PdfReader(io.BytesIO(pdf_data))
+            total_pages = len(pdf_reader.pages)
+            # Estimativa conservadora: 30% colorido
+            color_pages = max(1, int(total_pages * 0.3))
+            mono_pages = total_pages - color_pages
             
-            # Context manager garante cleanup automático
+            color_stats = {
+                'total_pages': total_pages,
+                'color_pages': color_pages,
+                'mono_pages': mono_pages,
+                'color_type': 'mixed' if color_pages > 0 else 'mono'
+            }
+            analysis_method = 'pypdf_estimate'
+        
+        analysis_duration = time.monotonic() - analysis_start
+        total_duration = time.monotonic() - operation_start
+        
+        # Log de performance estruturado
+        log_api_performance(
+            operation='pdf_analysis_url',
+            duration=total_duration,
+            file_size=downloaded,
+            success=True
+        )
+        
+        logger.info(
+            f"Análise completa - Método: {analysis_method}, "
+            f"Arquivo: {downloaded/1024:.1f}KB, "
+            f"Download: {download_duration:.2f}s, "
+            f"Análise: {analysis_duration:.2f}s, "
+            f"Total: {total_duration:.2f}s"
+        )
+        
+        # Retornar dados de análise com metadados de performance
+        return jsonify({
+            'success': True,
+            'data': {
+                'total_pages': color_stats['total_pages'],
+                'color_pages': color_stats['color_pages'], 
+                'mono_pages': color_stats['mono_pages'],
+                'color_type': color_stats['color_type'],
+                'analysis_method': analysis_method,
+                'file_size_bytes': downloaded,
+                'processing_time_seconds': round(total_duration, 2)
+            },
+            'message': f'PDF analisado com sucesso via {analysis_method} em {total_duration:.1f}s'
+        }), 200
     
     except Exception as e:
-        print(f"[ERROR] Erro na análise PDF via URL: {str(e)}")
+        logger.error(f"Erro na análise PDF via URL: {e}")
         return jsonify({
             'success': False,
             'error': f'Erro interno: {str(e)}',
@@ -1852,18 +3224,15 @@ def process_pdf_analysis_job(job):
     """
     try:
         # Parse dos dados de entrada
-        input_data = json.loads(job.input_data)
+        input_data = job.get_input()
         pdf_url = input_data['pdf_url']
         api_key = input_data['api_key']
         file_size_hint = input_data.get('file_size_hint', 0)
         
         logger.info(f"Iniciando processamento assíncrono do job {job.id} para PDF: {pdf_url}")
         
-        # Atualizar status para 'running'
-        job.status = 'running'
-        job.started_at = datetime.now()
-        job.progress = 10
-        db.session.commit()
+        # status 'running', started_at e progresso 10% já foram gravados
+        # pelo claim_job(): nenhum commit até o download começar
         
         # Validações de segurança (similar ao código síncrono)
         from urllib.parse import urlparse
@@ -1874,14 +3243,14 @@ def process_pdf_analysis_job(job):
             raise ValueError('URL deve usar http:// ou https://')
         
         # DOWNLOAD SEGURO (mesma lógica do código síncrono)
-        operation_start = time.time()
+        operation_start = time.monotonic()
         
         # Conectar e baixar com timeout otimizado
         connect_timeout = 5
         read_timeout = PDF_DOWNLOAD_TIMEOUT
         
         logger.info(f"Job {job.id}: Iniciando download seguro de PDF")
-        response = requests.get(
+        response = PDF_DOWNLOAD_SESSION.get(
             pdf_url, 
             timeout=(connect_timeout, read_timeout), 
             stream=True, 
@@ -1899,15 +3268,12 @@ def process_pdf_analysis_job(job):
         if not content_type.startswith('application/pdf'):
             raise ValueError(f'Content-Type inválido: {content_type}')
         
-        job.progress = 20
-        db.session.commit()
-        
         # PROCESSAMENTO COM CONTEXT MANAGER
         with secure_temp_pdf_file() as temp_path:
             # Download em chunks com limite rígido
             downloaded = 0
             chunk_count = 0
-            download_start = time.time()
+            download_start = time.monotonic()
             
             expected_size = response.headers.get('content-length')
             if expected_size:
@@ -1916,10 +3282,22 @@ def process_pdf_analysis_job(job):
             
             job.progress = 30
             db.session.commit()
+            progress_saved_at = time.monotonic()
             
+            digest = _new_file_digest()
             with open(temp_path, 'wb') as temp_file:
+                # Reservar o tamanho anunciado de uma vez: extents contíguos em
+                # vez de o filesystem crescer o arquivo a cada chunk
+                preallocated = False
+                if expected_size and expected_size <= MAX_PDF_SIZE_TOTAL:
+                    try:
+                        os.posix_fallocate(temp_file.fileno(), 0, expected_size)
+                        preallocated = True
+                    except (AttributeError, OSError):
+                        pass
+                
                 try:
-                    for chunk in response.iter_content(chunk_size=64*1024):
+                    for chunk in response.iter_content(chunk_size=PDF_DOWNLOAD_CHUNK_SIZE):
                         if chunk:
                             chunk_count += 1
                             downloaded += len(chunk)
@@ -1929,39 +3307,48 @@ def process_pdf_analysis_job(job):
                                 raise ValueError(f'Arquivo muito grande: {downloaded/1024/1024:.1f}MB')
                             
                             temp_file.write(chunk)
+                            digest.update(chunk)
                             
-                            # Atualizar progresso do download (30% a 60%)
-                            if chunk_count % 50 == 0:  # Atualizar a cada 50 chunks (3.2MB)
-                                progress = 30 + int(30 * downloaded / MAX_PDF_SIZE_TOTAL)
+                            # Atualizar progresso do download (30% a 60%): no
+                            # máximo um commit a cada JOB_PROGRESS_INTERVAL
+                            # segundos, por mais rápido que o download seja
+                            now = time.monotonic()
+                            if now - progress_saved_at >= JOB_PROGRESS_INTERVAL:
+                                progress = min(30 + int(30 * downloaded / MAX_PDF_SIZE_TOTAL), 60)
                                 if progress != job.progress:
-                                    job.progress = min(progress, 60)
+                                    job.progress = progress
                                     db.session.commit()
+                                progress_saved_at = now
                                     
                 except requests.exceptions.RequestException as download_error:
                     raise ValueError(f'Erro durante download: {download_error}')
+                
+                # Corpo menor que o Content-Length: descartar os zeros reservados
+                if preallocated and downloaded < expected_size:
+                    temp_file.truncate(downloaded)
             
-            download_duration = time.time() - download_start
+            download_duration = time.monotonic() - download_start
             logger.info(f"Job {job.id}: Download concluído - {downloaded:,} bytes em {download_duration:.2f}s")
             
             job.progress = 70
             db.session.commit()
             
             # ANÁLISE DO PDF (70% a 90%)
-            analysis_start = time.time()
+            analysis_start = time.monotonic()
             
             try:
                 # Usar PyMuPDF
-                import pymupdf as fitz
+                _get_fitz()
                     
-                color_stats = analyze_pdf_colors(temp_path)
+                color_stats = analyze_pdf_colors_cached(temp_path, digest.hexdigest())
                 analysis_method = 'PyMuPDF_precise'
                 logger.info(f"Job {job.id}: Análise PyMuPDF concluída")
                 
             except ImportError:
-                # Fallback PyPDF2
-                logger.warning(f"Job {job.id}: PyMuPDF não disponível, usando PyPDF2")
+                # Fallback pypdf
+                logger.warning(f"Job {job.id}: PyMuPDF não disponível, usando pypdf")
                 with open(temp_path, 'rb') as pdf_file:
-                    pdf_reader = PyPDF2.PdfReader(pdf_file)
+                    pdf_reader = _get_pypdf().PdfReader(pdf_file)
                     total_pages = len(pdf_reader.pages)
                     color_pages = max(1, int(total_pages * 0.3))
                     mono_pages = total_pages - color_pages
@@ -1972,13 +3359,10 @@ def process_pdf_analysis_job(job):
                     'mono_pages': mono_pages,
                     'color_type': 'mixed' if color_pages > 0 else 'mono'
                 }
-                analysis_method = 'PyPDF2_estimate'
-            
-            analysis_duration = time.time() - analysis_start
-            total_duration = time.time() - operation_start
+                analysis_method = 'pypdf_estimate'
             
-            job.progress = 90
-            db.session.commit()
+            analysis_duration = time.monotonic() - analysis_start
+            total_duration = time.monotonic() - operation_start
             
             # Preparar resultado
             result_data = {
@@ -1995,7 +3379,7 @@ def process_pdf_analysis_job(job):
             job.status = 'completed'
             job.progress = 100
             job.completed_at = datetime.now()
-            job.result_data = json.dumps(result_data)
+            job.set_result(result_data)
             db.session.commit()
             
             logger.info(
@@ -2020,10 +3404,11 @@ def process_pdf_analysis_job(job):
         
         logger.error(f"Job {job.id} FALHOU: {str(e)}")
         
-        # Calcular duração se start_time estiver disponível no contexto da função
+        # Duração pelo relógio monotônico quando disponível (imune a ajustes
+        # de NTP); senão, pelo started_at gravado no banco
         job_duration = 0
         if 'operation_start' in locals():
-            job_duration = time.time() - operation_start
+            job_duration = time.monotonic() - operation_start
         elif hasattr(job, 'started_at') and job.started_at:
             job_duration = (datetime.now() - job.started_at).total_seconds()
         
@@ -2034,6 +3419,207 @@ def process_pdf_analysis_job(job):
             success=False
         )
 
+def analyze_uploaded_pdf(file_path, file_hash, data=None):
+    """
+    Analisa as cores de um PDF enviado pelo usuário e guarda no cache.
+    
+    data é o conteúdo do arquivo quando ele já está inteiro em memória
+    (uploads pequenos), evitando reler do disco o que acabou de ser gravado.
+    
+    A linha do cache não é commitada aqui: ela vai junto com o commit único
+    feito depois de apply_upload_to_user().
+    
+    Returns:
+        dict: color_stats, ou None se o arquivo estiver corrompido (o arquivo
+        é removido nesse caso)
+    """
+    # Abrir o PDF uma única vez: o mesmo documento fornece a contagem
+    # de páginas e alimenta a análise de cores. O PyMuPDF já repara xref e
+    # estrutura danificados ao abrir; se nem ele abre, o arquivo é inválido
+    fitz = _get_fitz()
+    with _pdf_analysis_lock:
+        try:
+            if data is not None:
+                pdf_document = fitz.open(stream=data, filetype='pdf')
+            else:
+                pdf_document = fitz.open(file_path)
+        except fitz.FileDataError:
+            os.remove(file_path)
+            return None
+
+        with pdf_document:
+            color_stats = analyze_pdf_colors(pdf_document, file_path=file_path)
+    if color_stats_cacheable(color_stats):
+        store_color_stats(file_hash, color_stats, commit=False)
+    return color_stats
+
+# Nome dado pelo /upload ao arquivo em disco (uuid4 hex). Arquivos antigos,
+# gravados com o nome enviado pelo cliente, podem ser de mais de um usuário
+# e nunca são removidos automaticamente
+_STORED_UPLOAD_NAME = re.compile(r'[0-9a-f]{32}\.pdf')
+
+def remove_replaced_upload(previous_name, current_name):
+    """Remove de uploads/ o arquivo que o usuário deixou de referenciar (chamar após o commit)"""
+    if (not previous_name or previous_name == current_name
+            or not _STORED_UPLOAD_NAME.fullmatch(previous_name)):
+        return
+    try:
+        os.remove(os.path.join('uploads', previous_name))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Não foi possível remover o upload substituído {previous_name}: {e}")
+
+def apply_upload_to_user(user, file_name, color_stats):
+    """
+    Grava o resultado da análise no usuário e monta a resposta do /upload.
+    
+    Não faz commit: quem chama grava tudo (usuário, cache e job) de uma vez.
+    """
+    num_pages = color_stats['total_pages']
+    estimated_cost = calculate_estimated_cost(color_stats['color_pages'], color_stats['mono_pages'])
+
+    # Atualizar informações do usuário com dados de cor
+    user.uploaded_file = file_name
+    user.num_pages = num_pages
+    user.color_type = color_stats['color_type']
+    user.color_pages = color_stats['color_pages']
+    user.mono_pages = color_stats['mono_pages'] 
+    user.estimated_cost = estimated_cost
+    # Páginas mudaram: o carrinho recalcula o detalhamento até o próximo /configure
+    user.cost_details_json = None
+
+    return {
+        'pages': num_pages,
+        'color_type': color_stats['color_type'],
+        'color_pages': color_stats['color_pages'],
+        'mono_pages': color_stats['mono_pages'],
+        'estimated_cost': estimated_cost,
+        'redirect_to_configure': True
+    }
+
+def process_upload_analysis_job(job):
+    """
+    Processa a análise de cores de um PDF enviado via /upload
+    """
+    try:
+        input_data = job.get_input()
+        
+        # status 'running' já gravado pelo claim_job(): o próximo commit é o
+        # resultado final (usuário, cache e job numa transação só)
+        user = db.session.get(User, input_data['user_id'])
+        if not user:
+            raise ValueError('Usuário não encontrado')
+        
+        color_stats = analyze_uploaded_pdf(input_data['file_path'], input_data['file_hash'])
+        if color_stats is None:
+            raise ValueError('PDF corrompido ou inválido. Tente outro arquivo.')
+        
+        previous_file = user.uploaded_file
+        result_data = apply_upload_to_user(user, input_data['file_name'], color_stats)
+        result_data['status'] = 'completed'
+        
+        job.status = 'completed'
+        job.progress = 100
+        job.completed_at = datetime.now()
+        job.set_result(result_data)
+        db.session.commit()
+        remove_replaced_upload(previous_file, input_data['file_name'])
+        
+        logger.info(f"Job {job.id} CONCLUÍDO - upload {input_data['file_name']}: {color_stats['total_pages']} páginas")
+        
+    except Exception as e:
+        db.session.rollback()
+        job.status = 'failed'
+        job.completed_at = datetime.now()
+        job.error_message = str(e)[:500]
+        db.session.commit()
+        
+        logger.error(f"Job {job.id} FALHOU: {str(e)}")
+
+_JOB_IS_PENDING = text("job.status = 'pending'")
+
+# O worker ocioso não consulta o banco a cada 2s: jobs criados neste processo
+# o acordam na hora (notify_job_worker) e, sem aviso, ele só volta a procurar
+# jobs pendentes a cada JOB_SWEEP_INTERVAL segundos (jobs de outros workers
+# gunicorn ou que sobraram de um restart)
+JOB_SWEEP_INTERVAL = float(os.getenv('JOB_SWEEP_INTERVAL', '60'))
+_job_wakeup = threading.Event()
+
+# Threads de worker por processo: um PDF grande (download lento) não segura
+# a fila inteira. Os downloads correm em paralelo; a análise passa por
+# _pdf_analysis_lock, como a dos requests síncronos
+JOB_WORKERS = max(1, int(os.getenv('JOB_WORKERS', '2')))
+
+def claim_job(job_id):
+    """
+    Marca o job como 'running' (progresso 10%) se ele ainda estiver pendente.
+    Retorna False quando outra thread (ou outro processo) já o pegou.
+    
+    É o único commit do início do job: as funções process_* não regravam o
+    status.
+    """
+    claimed = db.session.execute(
+        update(Job)
+        .where(Job.id == job_id, _JOB_IS_PENDING)
+        .values(status='running', started_at=datetime.now(), progress=10)
+    ).rowcount
+    db.session.commit()
+    if claimed == 1:
+        notify_job_status(job_id)
+    return claimed == 1
+
+def notify_job_worker():
+    """Acorda o worker assíncrono; chamar depois do commit do job novo"""
+    _job_wakeup.set()
+
+# Long-poll do status (GET /api/v1/jobs/<id>?wait=N): o request espera até
+# JOB_LONG_POLL_MAX_WAIT segundos e volta assim que o worker muda o status
+# do job (pending -> running -> completed/failed). O aviso é por processo: se
+# o job roda em outro worker gunicorn, a resposta sai no fim da espera
+JOB_LONG_POLL_MAX_WAIT = float(os.getenv('JOB_LONG_POLL_MAX_WAIT', '30'))
+_job_status_waiters = {}  # job_id -> [threading.Event, requests esperando]
+_job_status_lock = threading.Lock()
+
+def wait_for_job_status_change(job_id, timeout):
+    """Bloqueia até notify_job_status(job_id) ou timeout; True se houve aviso"""
+    with _job_status_lock:
+        entry = _job_status_waiters.get(job_id)
+        if entry is None:
+            entry = _job_status_waiters[job_id] = [threading.Event(), 0]
+        entry[1] += 1
+    try:
+        return entry[0].wait(timeout)
+    finally:
+        with _job_status_lock:
+            entry[1] -= 1
+            if entry[1] == 0 and _job_status_waiters.get(job_id) is entry:
+                del _job_status_waiters[job_id]
+
+def notify_job_status(job_id):
+    """Libera os long-polls deste job; chamar depois do commit da mudança de status"""
+    with _job_status_lock:
+        entry = _job_status_waiters.get(job_id)
+    if entry is not None:
+        entry[0].set()
+
+# Jobs vencidos saem num DELETE em lote a cada JOB_SWEEP_INTERVAL segundos
+# (compartilhado pelas threads do processo), e não um a um no polling
+_jobs_purged_at = [0.0]
+
+def purge_expired_jobs():
+    """Remove de uma vez todos os jobs com expires_at no passado"""
+    now = time.monotonic()
+    if now - _jobs_purged_at[0] < JOB_SWEEP_INTERVAL:
+        return
+    _jobs_purged_at[0] = now
+    removed = db.session.execute(
+        delete(Job).where(Job.expires_at < datetime.now())
+    ).rowcount
+    db.session.commit()
+    if removed:
+        logger.info(f"{removed} jobs expirados removidos")
+
 def async_worker():
     """
     Worker thread que processa jobs pendentes continuamente
@@ -2042,40 +3628,59 @@ def async_worker():
     
     while True:
         try:
+            # Limpar o aviso antes da busca: um job criado durante a consulta
+            # mantém o evento ligado e o wait abaixo retorna na hora
+            _job_wakeup.clear()
+            
             # CRÍTICO: Flask context necessário para acessar banco de dados
             with app.app_context():
-                # Buscar próximo job pendente
-                job = Job.query.filter_by(status='pending').order_by(Job.created_at).first()
+                purge_expired_jobs()
+                
+                # Buscar próximo job pendente e ainda válido (o status vai
+                # literal na consulta para o SQLite reconhecer o índice
+                # parcial idx_job_pending_created). No PostgreSQL a linha é
+                # travada com SKIP LOCKED: workers concorrentes pegam jobs
+                # diferentes em vez de disputar o mesmo no claim_job (o
+                # SQLite ignora o FOR UPDATE)
+                job = (Job.query.filter(_JOB_IS_PENDING, Job.expires_at >= datetime.now())
+                       .order_by(Job.created_at)
+                       .with_for_update(skip_locked=True)
+                       .first())
             
+                if job and not claim_job(job.id):
+                    # Outro worker pegou este job entre a busca e o UPDATE
+                    continue
+                
                 if job:
-                    # Verificar se não expirou
-                    if job.expires_at < datetime.now():
-                        logger.info(f"Job expirado removido pelo worker: {job.id}")
-                        db.session.delete(job)
-                        db.session.commit()
-                        continue
-                    
                     # Processar job
                     if job.job_type == 'pdf_analysis_url':
                         process_pdf_analysis_job(job)
+                    elif job.job_type == 'pdf_analysis_upload':
+                        process_upload_analysis_job(job)
                     else:
                         logger.warning(f"Tipo de job desconhecido: {job.job_type}")
                         job.status = 'failed'
                         job.error_message = f'Tipo de job não suportado: {job.job_type}'
                         db.session.commit()
+                    # Concluído ou falhou: liberar quem espera o status
+                    notify_job_status(job.id)
                 else:
-                    # Sem jobs pendentes, aguardar
-                    time.sleep(2)
+                    # Sem jobs pendentes, aguardar um job novo ou a próxima varredura
+                    _job_wakeup.wait(JOB_SWEEP_INTERVAL)
                 
         except Exception as e:
             logger.error(f"Erro no worker assíncrono: {str(e)}")
             time.sleep(5)  # Aguardar mais em caso de erro
 
-# Iniciar worker thread em background
-worker_thread = threading.Thread(target=async_worker, daemon=True)
-worker_thread.start()
+# Iniciar worker threads em background
+worker_threads = [
+    threading.Thread(target=async_worker, name=f'job-worker-{n}', daemon=True)
+    for n in range(JOB_WORKERS)
+]
+for worker_thread in worker_threads:
+    worker_thread.start()
 
-logger.info("Sistema assíncrono inicializado - worker thread iniciado")
+logger.info(f"Sistema assíncrono inicializado - {JOB_WORKERS} worker threads iniciados")
 
 # ============================================
 # ENDPOINT PARA POLLING DE JOBS ASSÍNCRONOS - PRIORIDADE 1
@@ -2088,6 +3693,8 @@ def api_get_job_status(job_id):
     Endpoint para consultar status de jobs assíncronos via polling
     
     GET /api/v1/jobs/<job_id>
+    GET /api/v1/jobs/<job_id>?wait=30  (long-poll: responde na próxima mudança
+    de status ou após wait segundos, no máximo JOB_LONG_POLL_MAX_WAIT)
     Response:
     - 200: Job encontrado (pending, running, completed, failed)
     - 404: Job não encontrado ou expirado
@@ -2095,11 +3702,7 @@ def api_get_job_status(job_id):
     """
     # CORS headers para WordPress
     if request.method == 'OPTIONS':
-        return '', 200, {
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET, OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type, X-API-Key',
-        }
+        return '', 204, _JOB_STATUS_PREFLIGHT_HEADERS
     
     try:
         # Buscar job no banco
@@ -2112,17 +3715,36 @@ def api_get_job_status(job_id):
                 'error_code': 'JOB_NOT_FOUND'
             }), 404
         
-        # Verificar se job expirou
+        # Verificar se job expirou (a remoção fica para o worker, em lote)
         if job.expires_at < datetime.now():
-            logger.info(f"Job expirado removido: {job_id}")
-            db.session.delete(job)
-            db.session.commit()
             return jsonify({
                 'success': False,
                 'error': 'Job expirado',
                 'error_code': 'JOB_EXPIRED'
             }), 410  # Gone
         
+        # Long-poll opcional: enquanto o job está na fila ou rodando, esperar
+        # a próxima mudança de status em vez de o cliente repetir o GET
+        wait = min(request.args.get('wait', 0, type=float), JOB_LONG_POLL_MAX_WAIT)
+        if wait > 0 and job.status in ('pending', 'running'):
+            db.session.rollback()  # não segurar a transação/conexão durante a espera
+            wait_for_job_status_change(job_id, wait)
+            job = db.session.get(Job, job_id, populate_existing=True)
+            if job is None:
+                return jsonify({
+                    'success': False,
+                    'error': 'Job não encontrado',
+                    'error_code': 'JOB_NOT_FOUND'
+                }), 404
+        
+        # O corpo só muda junto com (status, progresso): polls repetidos com
+        # o mesmo ETag recebem 304 sem corpo. no-cache obriga o cliente a
+        # revalidar a cada poll em vez de reaproveitar a resposta
+        etag = f'{job.status}-{job.progress}'
+        cache_headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+        if request.if_none_match.contains(etag):
+            return '', 304, cache_headers
+        
         # Preparar resposta baseada no status
         response_data = {
             'job_id': job.id,
@@ -2146,7 +3768,7 @@ def api_get_job_status(job_id):
             
         elif job.status == 'completed':
             # Job concluído - retornar resultado
-            result_data = json.loads(job.result_data) if job.result_data else {}
+            result_data = job.get_result()
             response_data.update({
                 'success': True,
                 'message': 'PDF processado com sucesso',
@@ -2162,7 +3784,7 @@ def api_get_job_status(job_id):
                 'completed_at': job.completed_at.isoformat() if job.completed_at else None
             })
         
-        return jsonify(response_data), 200
+        return jsonify(response_data), 200, cache_headers
         
     except Exception as e:
         logger.error(f"Erro ao consultar job {job_id}: {str(e)}")
@@ -2172,6 +3794,76 @@ def api_get_job_status(job_id):
             'error_code': 'INTERNAL_ERROR'
         }), 500
 
+# ============================================
+# CONSULTA DE CEP (VIACEP)
+# ============================================
+
+CEP_CACHE_TTL = timedelta(days=int(os.getenv('CEP_CACHE_TTL_DAYS', '30')))
+
+# LRU em memória na frente da tabela cep_cache: cep -> (fetched_at, endereço).
+# Mesma validade da tabela; CEPs inexistentes ('erro') não entram
+CEP_MEMORY_CACHE_SIZE = 4096
+_cep_memo = collections.OrderedDict()
+_cep_memo_lock = threading.Lock()
+
+def _remember_cep(cep_clean, fetched_at, address_data):
+    with _cep_memo_lock:
+        _cep_memo[cep_clean] = (fetched_at, address_data)
+        _cep_memo.move_to_end(cep_clean)
+        while len(_cep_memo) > CEP_MEMORY_CACHE_SIZE:
+            _cep_memo.popitem(last=False)
+
+# Sessão persistente: reaproveita conexões TLS com o ViaCEP entre cadastros
+VIACEP_SESSION = requests.Session()
+VIACEP_SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=10))
+# (conexão, leitura): um ViaCEP fora do ar falha o cadastro em 2s, não em 10s
+VIACEP_TIMEOUT = (2, 5)
+
+def lookup_cep(cep_clean):
+    """
+    Consulta o endereço de um CEP (8 dígitos, já validado).
+    
+    Ordem: LRU em memória -> tabela cep_cache (ambos válidos por
+    CEP_CACHE_TTL) -> ViaCEP. Retorna sempre um dict novo: quem chama pode
+    alterá-lo sem afetar o cache.
+    Levanta requests.exceptions.RequestException se a consulta ao ViaCEP falhar.
+    """
+    valid_after = datetime.now() - CEP_CACHE_TTL
+    with _cep_memo_lock:
+        entry = _cep_memo.get(cep_clean)
+        if entry is not None:
+            if entry[0] > valid_after:
+                _cep_memo.move_to_end(cep_clean)
+                return dict(entry[1])
+            del _cep_memo[cep_clean]
+    
+    cached = db.session.get(CepCache, cep_clean)
+    if cached is not None and cached.fetched_at > valid_after:
+        address_data = orjson.loads(cached.payload)
+        _remember_cep(cep_clean, cached.fetched_at, address_data)
+        return dict(address_data)
+    
+    response = VIACEP_SESSION.get(f'https://viacep.com.br/ws/{cep_clean}/json/', timeout=VIACEP_TIMEOUT)
+    response.raise_for_status()
+    address_data = orjson.loads(response.content)
+    
+    # Guardar apenas CEPs válidos
+    if 'erro' not in address_data:
+        fetched_at = datetime.now()
+        _remember_cep(cep_clean, fetched_at, dict(address_data))
+        try:
+            db.session.merge(CepCache(
+                cep=cep_clean,
+                payload=orjson.dumps(address_data).decode(),
+                fetched_at=fetched_at
+            ))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Falha ao gravar cache do CEP {cep_clean}: {e}")
+    
+    return address_data
+
 # ============================================
 # ROTAS PRINCIPAIS DO SISTEMA (EXISTENTES)
 # ============================================
@@ -2180,17 +3872,26 @@ def api_get_job_status(job_id):
 def index():
     return render_template('index.html')
 
+USERS_PER_PAGE = 50
+
 @app.route('/users')
 def users():
-    all_users = User.query.all()  # Obtém todos os usuários
-    return render_template('users.html', users=all_users)
+    # Listagem paginada: cada acesso carrega no máximo USERS_PER_PAGE usuários,
+    # em vez da tabela inteira, e só as colunas exibidas na tabela
+    pagination = User.query.options(load_only(
+        User.id, User.name, User.cpf, User.address, User.cep,
+        User.uploaded_file, User.num_pages
+    )).order_by(User.id).paginate(
+        page=request.args.get('page', 1, type=int), per_page=USERS_PER_PAGE, error_out=False)
+    return render_template('users.html', users=pagination.items, pagination=pagination)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         try:
             name = request.form.get('name', '').strip()
-            cpf = request.form.get('cpf', '').strip()
+            cpf_input = request.form.get('cpf', '').strip()
+            cpf = digits_only(cpf_input)
             cep = request.form.get('cep', '').strip()
 
             # Validar campos obrigatórios
@@ -2198,21 +3899,18 @@ def register():
                 return render_template('register.html', error='Todos os campos são obrigatórios')
 
             # Validar formato do CEP (apenas dígitos, 5 ou 8 dígitos, com ou sem hífen)
-            import re
-            cep_clean = re.sub(r'[^0-9]', '', cep)
-            if not re.match(r'^\d{8}$', cep_clean):
+            cep_clean = digits_only(cep)
+            if len(cep_clean) != 8:
                 return render_template('register.html', error='CEP deve conter exatamente 8 dígitos')
 
             # Verificar se o CPF já existe
-            existing_user = User.query.filter_by(cpf=cpf).first()
+            existing_user = find_user_by_cpf_input(cpf_input)
             if existing_user:
                 return render_template('register.html', error='CPF já cadastrado')
 
             # Buscar endereço a partir do CEP (usando CEP validado)
             try:
-                response = requests.get(f'https://viacep.com.br/ws/{cep_clean}/json/', timeout=10)
-                response.raise_for_status()
-                address_data = response.json()
+                address_data = lookup_cep(cep_clean)
             except requests.exceptions.RequestException:
                 return render_template('register.html', error='Erro ao consultar CEP. Tente novamente.')
 
@@ -2246,18 +3944,18 @@ def register():
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        cpf = request.form.get('cpf', '').strip()
+        cpf_input = request.form.get('cpf', '').strip()
         
-        if not cpf:
+        if not digits_only(cpf_input):
             return render_template('login.html', error='CPF é obrigatório')
         
         # Verificar se o usuário existe
-        user = User.query.filter_by(cpf=cpf).first()
+        user = find_user_by_cpf_input(cpf_input)
         if not user:
             return render_template('login.html', error='CPF não encontrado. Faça seu cadastro primeiro.')
         
-        # Configurar sessão e redirecionar
-        session['cpf'] = cpf
+        # Configurar sessão e redirecionar (com o CPF como está no banco)
+        session['cpf'] = user.cpf
         session.permanent = True
         return redirect(url_for('upload'))
     
@@ -2270,6 +3968,10 @@ def upload():
 
     if request.method == 'POST':
         try:
+            # Rejeitar pelo Content-Length antes de ler (e bufferizar) o corpo
+            if request.content_length and request.content_length > MAX_UPLOAD_SIZE:
+                return jsonify({'error': UPLOAD_TOO_LARGE_ERROR}), 413
+
             # Verificar se o arquivo foi enviado
             if 'file' not in request.files:
                 return jsonify({'error': 'Nenhum arquivo foi enviado'}), 400
@@ -2281,97 +3983,121 @@ def upload():
                 return jsonify({'error': 'Nenhum arquivo foi selecionado'}), 400
             
             # Verificar se é um arquivo PDF
-            if not file.filename.lower().endswith('.pdf'):
+            if not has_pdf_extension(file.filename):
                 return jsonify({'error': 'Apenas arquivos PDF são aceitos'}), 400
 
+            # Validar o header PDF logo no início, antes de qualquer gravação:
+            # arquivos inválidos são rejeitados sem tocar o disco
+            first_chunk = read_pdf_first_chunk(file.stream)
+            if first_chunk is None:
+                file.close()
+                return jsonify({'error': 'Arquivo não é um PDF válido'}), 400
+
             # Buscar o usuário na sessão
-            user = User.query.filter_by(cpf=session['cpf']).first()
+            user = get_current_user()
             if not user:
                 return jsonify({'error': 'Usuário não encontrado. Faça o registro novamente.'}), 400
 
-            # Ler o PDF e contar páginas com tratamento robusto
-            try:
-                # Primeira tentativa: ler diretamente do stream
-                file.stream.seek(0)  # Garantir que está no início
-                
-                # Verificar se o arquivo começa com header PDF válido
-                header = file.stream.read(8)
-                if not header.startswith(b'%PDF-'):
-                    return jsonify({'error': 'Arquivo não é um PDF válido'}), 400
-                
-                # Voltar ao início para leitura completa
-                file.stream.seek(0)
-                
-                # Tentar ler com PyPDF2
-                pdf_reader = PyPDF2.PdfReader(file.stream)
-                num_pages = len(pdf_reader.pages)
+            # No disco o arquivo recebe sempre um nome aleatório: nada do nome
+            # enviado pelo cliente chega ao caminho, e uploads de usuários
+            # diferentes com o mesmo nome não se sobrescrevem. É esse nome que
+            # vai para user.uploaded_file (servido por /uploads/<filename>);
+            # o original (higienizado) aparece só nos logs
+            secure_name = secure_filename(file.filename)[:200] or 'arquivo.pdf'
+            stored_name = f"{uuid.uuid4().hex}.pdf"
+            file_path = os.path.join('uploads', stored_name)
+            
+            # Salvar o arquivo em uma única passada, calculando o hash enquanto copia
+            file_hash = save_pdf_upload(first_chunk, file.stream, file_path)
+            if file_hash is None:
+                return jsonify({'error': UPLOAD_TOO_LARGE_ERROR}), 413
+
+            # Reenvio do mesmo conteúdo: reaproveitar a análise já feita
+            color_stats = get_cached_color_stats(file_hash)
+
+            if color_stats is None and os.path.getsize(file_path) > UPLOAD_ASYNC_MIN_SIZE:
+                # Arquivo grande sem análise em cache: processar no worker
+                # assíncrono e liberar o request imediatamente
+                job_id = str(uuid.uuid4())
+                job = Job(
+                    id=job_id,
+                    job_type='pdf_analysis_upload',
+                    status='pending',
+                    progress=0,
+                    expires_at=datetime.now() + timedelta(hours=2)
+                )
+                job.set_input({
+                    'file_path': file_path,
+                    'file_name': stored_name,
+                    'file_hash': file_hash,
+                    'user_id': user.id
+                })
+                db.session.add(job)
+                db.session.commit()
+                notify_job_worker()
                 
-            except Exception as pdf_error:
-                # Se falhar, tentar método alternativo salvando temporariamente
-                try:
-                    # Salvar temporariamente para leitura
-                    file.stream.seek(0)
-                    temp_path = os.path.join('uploads', f'temp_{file.filename}')
-                    file.save(temp_path)
-                    
-                    # Tentar ler do arquivo salvo
-                    with open(temp_path, 'rb') as temp_file:
-                        pdf_reader = PyPDF2.PdfReader(temp_file)
-                        num_pages = len(pdf_reader.pages)
-                    
-                    # Remover arquivo temporário
-                    os.remove(temp_path)
-                    
-                except Exception:
+                logger.info(f"Upload enfileirado: job {job_id} para {secure_name}")
+                return jsonify({
+                    'job_id': job_id,
+                    'status': 'processing',
+                    'status_url': url_for('upload_status', job_id=job_id)
+                }), 202
+
+            if color_stats is None:
+                # Upload menor que um bloco: first_chunk já é o arquivo inteiro
+                whole_file = first_chunk if len(first_chunk) < UPLOAD_CHUNK_SIZE else None
+                color_stats = analyze_uploaded_pdf(file_path, file_hash, whole_file)
+                if color_stats is None:
                     return jsonify({'error': 'PDF corrompido ou inválido. Tente outro arquivo.'}), 400
 
-            # Gerar nome seguro para o arquivo
-            secure_name = secure_filename(file.filename)
-            if not secure_name:
-                secure_name = f"arquivo_{uuid.uuid4().hex}.pdf"
-            
-            # Garantir extensão .pdf
-            if not secure_name.lower().endswith('.pdf'):
-                secure_name = f"{secure_name}.pdf"
-            
-            # Salvar o arquivo primeiro para análise
-            file.stream.seek(0)  # Voltar ao início do stream
-            file_path = os.path.join('uploads', secure_name)
-            file.save(file_path)
-
-            # Analisar cores do PDF
-            color_stats = analyze_pdf_colors(file_path)
-            estimated_cost = calculate_estimated_cost(color_stats['color_pages'], color_stats['mono_pages'])
-
-            # Atualizar informações do usuário com dados de cor
-            user.uploaded_file = secure_name
-            user.num_pages = num_pages
-            user.color_type = color_stats['color_type']
-            user.color_pages = color_stats['color_pages']
-            user.mono_pages = color_stats['mono_pages'] 
-            user.estimated_cost = estimated_cost
+            previous_file = user.uploaded_file
+            result = apply_upload_to_user(user, stored_name, color_stats)
             db.session.commit()
-
-            return jsonify({
-                'pages': num_pages,
-                'color_type': color_stats['color_type'],
-                'color_pages': color_stats['color_pages'],
-                'mono_pages': color_stats['mono_pages'],
-                'estimated_cost': estimated_cost,
-                'redirect_to_configure': True
-            })
+            remove_replaced_upload(previous_file, stored_name)
+            return jsonify(result)
             
+        except RequestEntityTooLarge:
+            raise  # resposta JSON em request_entity_too_large()
         except Exception as e:
+            db.session.rollback()
             return jsonify({'error': f'Erro ao processar arquivo: {str(e)}'}), 500
 
     return render_template('upload.html')
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_entity_too_large(e):
+    """Corpo acima de MAX_CONTENT_LENGTH: o /upload responde no mesmo formato JSON dos seus erros"""
+    if request.endpoint == 'upload':
+        return jsonify({'error': UPLOAD_TOO_LARGE_ERROR}), 413
+    return e
+
+@app.route('/upload/status/<job_id>')
+def upload_status(job_id):
+    """Polling do processamento assíncrono de um upload"""
+    if 'cpf' not in session:
+        return jsonify({'error': 'Sessão expirada. Faça o login novamente.'}), 401
+    
+    user = get_current_user()
+    job = db.session.get(Job, job_id)
+    if (not user or not job or job.job_type != 'pdf_analysis_upload'
+            or job.get_input().get('user_id') != user.id):
+        return jsonify({'error': 'Processamento não encontrado'}), 404
+    
+    if job.status == 'completed':
+        return jsonify(job.get_result())
+    if job.status == 'failed':
+        return jsonify({'status': 'failed', 'error': job.error_message or 'Falha ao processar o PDF'})
+    if job.expires_at < datetime.now():
+        return jsonify({'error': 'Processamento expirado. Envie o arquivo novamente.'}), 410
+    
+    return jsonify({'status': job.status, 'progress': job.progress}), 202
+
 @app.route('/configure', methods=['GET', 'POST'])
 def configure():
     if 'cpf' not in session:
         return redirect(url_for('register'))
 
-    user = User.query.filter_by(cpf=session['cpf']).first()
+    user = get_current_user()
     if not user or not user.uploaded_file:
         return redirect(url_for('upload'))
 
@@ -2418,6 +4144,7 @@ def configure():
             user.finishing = finishing if finishing else None
             user.copy_quantity = copy_quantity
             user.total_cost = cost_details['total_cost']
+            user.cost_details_json = orjson.dumps(cost_details).decode()
             user.order_configured = True
             
             db.session.commit()
@@ -2434,14 +4161,22 @@ def cart():
     if 'cpf' not in session:
         return redirect(url_for('register'))
 
-    user = User.query.filter_by(cpf=session['cpf']).first()
+    user = get_current_user()
     
     if not user or not user.uploaded_file:
         return render_template('cart.html', 
                              error="Nenhum arquivo foi enviado ainda. Faça o upload primeiro.")
     
     # Verificar se o pedido foi configurado
-    if user.order_configured:
+    if user.order_configured and user.cost_details_json:
+        # Detalhamento gravado no /configure: nada a recalcular
+        cart_data = {
+            'user': user,
+            'configured': True,
+            'cost_details': orjson.loads(user.cost_details_json)
+        }
+    elif user.order_configured:
+        # Pedidos antigos (sem detalhamento gravado)
         # Calcular páginas baseado no tipo de impressão escolhido
         if user.print_type == 'color':
             # Tudo em cores